@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import asyncio
+import traceback
+
+from .loudness import measure_loudness
+
+
+class AudioCache:
+    """
+        An in memory index of the files in the audio cache folder, so checking if a song has already been
+        downloaded doesn't need to list the whole folder.
+
+        Files are indexed by their name without the extension, which (thanks to the ytdl output template)
+        starts with the extractor and the video id.  The index is persisted to a small sidecar file in the
+        cache folder and reconciled against the folder once at startup.
+
+        Every record also tracks how often and how recently the file was used, which `evict` uses to keep
+        the folder under a size budget and drop files that haven't been played in a while.  If loudness
+        analysis is enabled, the integrated loudness of each file is measured once and stored in its record.
+        The size of a file's opus frame cache (see opuscache.py) is stored with it too, and counts towards the
+        size budget.
+    """
+
+    INDEX_FILENAME = '.index.json'
+    OPUS_SUFFIX = '.frames'
+    IGNORED_SUFFIXES = ('.part', '.ytdl', '.tmp', INDEX_FILENAME)
+
+    # How many seconds of recency a single hit is worth when picking files to evict
+    HIT_WEIGHT = 6 * 60 * 60
+    MAX_HIT_BONUS = 7 * 24 * 60 * 60
+
+    def __init__(self, folder, *, max_size=0, max_age=0, analyze_loudness=False):
+        self.folder = folder
+        self.max_size = max_size
+        self.max_age = max_age
+        self.analyze_loudness = analyze_loudness
+        self.index_file = os.path.join(folder, self.INDEX_FILENAME)
+        self.loop = asyncio.get_event_loop()
+
+        self._records = {}
+        self._generic = {}
+        self._build_future = None
+        self._save_handle = None
+
+        self._analyzing = set()
+        self._analysis_lock = asyncio.Lock()
+
+    @staticmethod
+    def _stem(filename):
+        return os.path.basename(filename).rsplit('.', 1)[0]
+
+    @staticmethod
+    def _generic_key(stem):
+        # Files from the generic extractor get part of their hash appended, see URLPlaylistEntry._really_download
+        return stem.rsplit('-', 1)[0]
+
+    @property
+    def ready(self):
+        return bool(self._build_future and self._build_future.done())
+
+    async def wait_ready(self):
+        """
+            Builds the index in the background the first time it's called, and waits for it to be done.
+        """
+        if not self._build_future:
+            self._build_future = self.loop.run_in_executor(None, self._build)
+
+        await asyncio.shield(self._build_future)
+
+    def _build(self):
+        try:
+            with open(self.index_file, encoding='utf8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = {}
+        except Exception:
+            traceback.print_exc()
+            print("[AudioCache] No se pudo leer el índice del caché, reconstruyéndolo")
+            saved = {}
+
+        records = {}
+
+        if os.path.isdir(self.folder):
+            for dentry in os.scandir(self.folder):
+                if not dentry.is_file() or dentry.name.endswith(self.IGNORED_SUFFIXES):
+                    continue
+
+                stat = dentry.stat()
+                stem = self._stem(dentry.name)
+                record = saved.get(stem, None)
+
+                # Reuse what we knew about the file unless it changed behind our back
+                if not record or record.get('file') != dentry.name or record.get('size') != stat.st_size \
+                        or record.get('mtime') != int(stat.st_mtime):
+                    record = self._make_record(dentry.name, stat, last_used=int(stat.st_mtime))
+
+                self._update_opus_size(record)
+                records[stem] = record
+
+        self._records = records
+        self._generic = {self._generic_key(stem): stem for stem in records if stem.startswith('generic-')}
+
+        if records != saved:
+            # The loop is free to change the records as soon as they're published above
+            self._save({k: dict(v) for k, v in records.items()})
+
+    @staticmethod
+    def _make_record(basename, stat, *, last_used=None):
+        return {
+            'file': basename,
+            'size': stat.st_size,
+            'mtime': int(stat.st_mtime),
+            'codec': basename.rsplit('.', 1)[-1] if '.' in basename else None,
+            'hits': 0,
+            'last_used': last_used or int(time.time())
+        }
+
+    def _get(self, stem):
+        record = self._records.get(stem, None)
+
+        if record and not os.path.isfile(self.path_for(record)):
+            # Someone deleted the file without telling us
+            self._forget(stem)
+            self._delete_files([self.opus_path_for(record['file'])])
+            return None
+
+        return record
+
+    def path_for(self, record):
+        return os.path.join(self.folder, record['file'])
+
+    def opus_path_for(self, filename):
+        """
+            Returns where the pre-encoded opus frames for a cached file go, see opuscache.py.
+        """
+        return os.path.join(self.folder, '.opus', self._stem(filename) + self.OPUS_SUFFIX)
+
+    def _update_opus_size(self, record):
+        try:
+            record['opus_size'] = os.path.getsize(self.opus_path_for(record['file']))
+        except OSError:
+            record.pop('opus_size', None)
+
+    def add_opus(self, opus_path):
+        """
+            Registers an opus frame cache file that was just written, so it's part of the size budget.
+        """
+        stem = os.path.basename(opus_path)[:-len(self.OPUS_SUFFIX)]
+        record = self._records.get(stem, None)
+
+        if record:
+            self._update_opus_size(record)
+            self._schedule_save()
+
+    def lookup(self, expected_filename):
+        """
+            Returns the index record for `expected_filename`, ignoring the extension, or None if it isn't cached.
+        """
+        return self._get(self._stem(expected_filename))
+
+    def lookup_generic(self, expected_filename):
+        """
+            Same as lookup, but for generic extractor files that have a hash appended to their name.
+        """
+        stem = self._generic.get(self._stem(expected_filename), None)
+        return self._get(stem) if stem else None
+
+    def add(self, filename):
+        """
+            Registers a file that just finished downloading.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        basename = os.path.basename(filename)
+        stem = self._stem(basename)
+
+        record = self._make_record(basename, stat)
+        self._update_opus_size(record)
+        self._records[stem] = record
+
+        if stem.startswith('generic-'):
+            self._generic[self._generic_key(stem)] = stem
+
+        self._schedule_save()
+        return record
+
+    def touch(self, filename):
+        """
+            Records a use of a cached file, so it's less likely to be evicted.
+        """
+        record = self._records.get(self._stem(filename), None)
+
+        if record:
+            record['hits'] = record.get('hits', 0) + 1
+            record['last_used'] = int(time.time())
+            self._schedule_save()
+
+    def loudness_of(self, filename):
+        """
+            Returns the measured integrated loudness of a cached file in LUFS, or None if we don't know it.
+        """
+        record = self._records.get(self._stem(filename), None)
+        return record.get('loudness', None) if record else None
+
+    def queue_analysis(self, filename):
+        """
+            Measures the loudness of a cached file in the background, if it hasn't been done already.
+        """
+        stem = self._stem(filename)
+        record = self._records.get(stem, None)
+
+        if not self.analyze_loudness or not record or 'loudness' in record or stem in self._analyzing:
+            return
+
+        self._analyzing.add(stem)
+        asyncio.ensure_future(self._analyze(stem, self.path_for(record)), loop=self.loop)
+
+    async def _analyze(self, stem, path):
+        try:
+            # These decode the whole file, one at a time is plenty
+            with await self._analysis_lock:
+                loudness = await measure_loudness(path, loop=self.loop)
+
+        except Exception:
+            traceback.print_exc()
+            print("[AudioCache] No se pudo analizar el volumen de %s" % path)
+            loudness = None
+
+        finally:
+            self._analyzing.discard(stem)
+
+        record = self._records.get(stem, None)
+
+        if record:
+            # Even if it failed, so we don't keep trying on a file ffmpeg can't measure
+            record['loudness'] = loudness
+            self._schedule_save()
+
+    @staticmethod
+    def _record_size(record):
+        return record['size'] + record.get('opus_size', 0)
+
+    @property
+    def total_size(self):
+        return sum(self._record_size(r) for r in self._records.values())
+
+    def _score(self, record):
+        return record.get('last_used', record['mtime']) + min(record.get('hits', 0) * self.HIT_WEIGHT, self.MAX_HIT_BONUS)
+
+    def _eviction_candidates(self, protected):
+        """
+            Returns the records that should be deleted to satisfy the size and age limits.
+        """
+        now = time.time()
+        candidates = []
+        kept = []
+
+        for stem, record in self._records.items():
+            if os.path.abspath(self.path_for(record)) in protected:
+                continue
+
+            if self.max_age and now - record.get('last_used', record['mtime']) > self.max_age:
+                candidates.append((stem, record))
+            else:
+                kept.append((stem, record))
+
+        if self.max_size:
+            size = self.total_size - sum(self._record_size(r) for _, r in candidates)
+
+            # Least recently used goes first, but popular files get a head start
+            for stem, record in sorted(kept, key=lambda i: self._score(i[1])):
+                if size <= self.max_size:
+                    break
+
+                candidates.append((stem, record))
+                size -= self._record_size(record)
+
+        return candidates
+
+    async def evict(self, protected=()):
+        """
+            Deletes files until the cache is within its size and age limits. Files in `protected` are never
+            touched.  Returns the number of bytes freed.
+        """
+        if not (self.max_size or self.max_age):
+            return 0
+
+        await self.wait_ready()
+
+        protected = {os.path.abspath(p) for p in protected if p}
+        candidates = self._eviction_candidates(protected)
+
+        if not candidates:
+            return 0
+
+        for stem, _ in candidates:
+            self._forget(stem)
+
+        paths = [self.path_for(r) for _, r in candidates]
+        paths.extend(self.opus_path_for(p) for p in list(paths))
+        freed = await self.loop.run_in_executor(None, self._delete_files, paths)
+
+        print("[AudioCache] Eliminados %s archivos del caché (%.1f MB)" % (len(candidates), freed / 1024 / 1024))
+        return freed
+
+    @staticmethod
+    def _delete_files(paths):
+        freed = 0
+
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+                os.unlink(path)
+                freed += size
+
+            except FileNotFoundError:
+                pass
+
+            except OSError as e:
+                # Most likely being played right now on windows, we'll get it next time
+                print("[AudioCache] No se pudo eliminar %s: %s" % (path, e))
+
+        return freed
+
+    def remove(self, filename):
+        self._forget(self._stem(filename))
+
+        try:
+            os.unlink(self.opus_path_for(filename))
+        except OSError:
+            pass
+
+    def _forget(self, stem):
+        if self._records.pop(stem, None):
+            if self._generic.get(self._generic_key(stem), None) == stem:
+                del self._generic[self._generic_key(stem)]
+
+            self._schedule_save()
+
+    def clear(self):
+        self._records.clear()
+        self._generic.clear()
+
+    def _schedule_save(self):
+        if not self._save_handle:
+            self._save_handle = self.loop.call_later(10, self._flush)
+
+    def _flush(self):
+        self._save_handle = None
+        self.loop.run_in_executor(None, self._save, {k: dict(v) for k, v in self._records.items()})
+
+    def _save(self, records):
+        if not os.path.isdir(self.folder):
+            return
+
+        try:
+            tmpfile = self.index_file + '.tmp'
+            with open(tmpfile, 'w', encoding='utf8') as f:
+                json.dump(records, f, separators=(',', ':'))
+
+            os.replace(tmpfile, self.index_file)
+
+        except Exception:
+            traceback.print_exc()
+            print("[AudioCache] No se pudo guardar el índice del caché")
@@ -23,10 +23,14 @@ from random import choice, shuffle
 from collections import defaultdict
 
 from musicbot.playlist import Playlist
+from musicbot.entry import URLPlaylistEntry
 from musicbot.player import MusicPlayer
+from musicbot.infocache import InfoCache
+from musicbot.queuejournal import QueueJournal
 from musicbot.config import Config, ConfigDefaults
 from musicbot.permissions import Permissions, PermissionsDefaults
-from musicbot.utils import load_file, write_file, sane_round_int
+from musicbot.voicesupervisor import VoiceSupervisor
+from musicbot.utils import load_file, write_file, sane_round_int, parse_timestamp
 
 from . import exceptions
 from . import downloader
@@ -64,6 +68,67 @@ class Response:
         self.delete_after = delete_after
 
 
+class Command:
+    """
+        Everything on_message needs to know about a command handler, worked out once from its signature
+        so that running a command doesn't need to inspect anything.
+    """
+
+    # Parameters that are filled in from the message instead of from what the user typed
+    INJECTED = {
+        'message': lambda message, permissions, player, leftover_args: message,
+        'channel': lambda message, permissions, player, leftover_args: message.channel,
+        'author': lambda message, permissions, player, leftover_args: message.author,
+        'server': lambda message, permissions, player, leftover_args: message.server,
+        'player': lambda message, permissions, player, leftover_args: player,
+        'permissions': lambda message, permissions, player, leftover_args: permissions,
+        'user_mentions': lambda message, permissions, player, leftover_args:
+            list(map(message.server.get_member, message.raw_mentions)),
+        'channel_mentions': lambda message, permissions, player, leftover_args:
+            list(map(message.server.get_channel, message.raw_channel_mentions)),
+        'voice_channel': lambda message, permissions, player, leftover_args: message.server.me.voice_channel,
+        'leftover_args': lambda message, permissions, player, leftover_args: leftover_args,
+    }
+
+    def __init__(self, name, handler, command_prefix):
+        self.name = name
+        self.handler = handler
+
+        params = inspect.signature(handler).parameters
+        self.injectors = tuple((key, self.INJECTED[key]) for key in params if key in self.INJECTED)
+        self.wants_player = 'player' in params
+        self.arg_names = tuple(key for key in params if key not in self.INJECTED)
+
+        # Arguments can't be skipped, so everything up to the last one without a default has to be given
+        self.min_args = 0
+        for i, key in enumerate(self.arg_names, 1):
+            if params[key].default is inspect.Parameter.empty:
+                self.min_args = i
+
+        args_expected = [
+            '[%s=%s]' % (key, params[key].default) if params[key].default is not inspect.Parameter.empty else key
+            for key in self.arg_names
+        ]
+
+        docs = getattr(handler, '__doc__', None)
+        if not docs:
+            docs = 'Uso: {}{} {}'.format(command_prefix, name, ' '.join(args_expected))
+
+        docs = '\n'.join(l.strip() for l in docs.split('\n'))
+        self.usage = '```\n%s\n```' % docs.format(command_prefix=command_prefix)
+
+    def bind(self, args, message, permissions, player=None):
+        """
+            Returns the keyword arguments to call the handler with.  `args` needs at least `min_args` items.
+        """
+        handler_kwargs = dict(zip(self.arg_names, args))
+
+        for key, inject in self.injectors:
+            handler_kwargs[key] = inject(message, permissions, player, args[len(self.arg_names):])
+
+        return handler_kwargs
+
+
 class MusicBot(discord.Client):
     def __init__(self, config_file=ConfigDefaults.options_file, perms_file=PermissionsDefaults.perms_file):
         self.players = {}
@@ -77,9 +142,34 @@ class MusicBot(discord.Client):
 
         self.blacklist = set(load_file(self.config.blacklist_file))
         self.autoplaylist = load_file(self.config.auto_playlist_file)
-        self.downloader = downloader.Downloader(download_folder='audio_cache')
+        self.downloader = downloader.Downloader(
+            download_folder='audio_cache',
+            info_cache=InfoCache(
+                self.config.info_cache_file,
+                max_entries=self.config.info_cache_size,
+                ttl=self.config.info_cache_ttl
+            ),
+            audio_cache_max_size=self.config.audio_cache_max_size * 1024 * 1024,
+            audio_cache_max_age=self.config.audio_cache_max_age * 24 * 60 * 60,
+            analyze_loudness=self.config.normalize_volume,
+            pool_sizes={
+                'metadata': self.config.metadata_workers,
+                'download': self.config.download_workers,
+                'prefetch': self.config.prefetch_workers
+            },
+            extractor_limits=self.config.extractor_concurrency,
+            backend=self.config.extraction_backend,
+            worker_max_jobs=self.config.extraction_worker_max_jobs,
+            metadata_timeout=self.config.metadata_timeout,
+            download_timeout=self.config.download_timeout
+        )
+
+        self.queue_journal = QueueJournal(self.config.queue_file) if self.config.persistent_queue else None
+        self._journaled = {}
 
         self.exit_signal = None
+        self.audio_cache_evictor = None
+        self.queue_journaler = None
         self.init_ok = False
         self.cached_client_id = None
 
@@ -88,13 +178,16 @@ class MusicBot(discord.Client):
             self.config.auto_playlist = False
 
         # TODO: Do these properly
-        ssd_defaults = {'last_np_msg': None, 'auto_paused': False}
+        ssd_defaults = {'last_np_msg': None, 'auto_paused': False, 'reconnect_paused': False}
         self.server_specific_data = defaultdict(lambda: dict(ssd_defaults))
 
         super().__init__()
         self.aiosession = aiohttp.ClientSession(loop=self.loop)
         self.http.user_agent += ' MusicBot/%s' % BOTVERSION
 
+        self.commands = self._build_command_table()
+        self.voice_supervisor = VoiceSupervisor(self)
+
     # TODO: Add some sort of `denied` argument for a message to send when someone else tries to use it
     def owner_only(func):
         @wraps(func)
@@ -113,6 +206,16 @@ class MusicBot(discord.Client):
     def _fixg(x, dp=2):
         return ('{:.%sf}' % dp).format(x).rstrip('0').rstrip('.')
 
+    def _build_command_table(self):
+        commands = {}
+
+        for att in sorted(dir(self)):
+            if att.startswith('cmd_'):
+                command = att[len('cmd_'):].lower()
+                commands[command] = Command(command, getattr(self, att), self.config.command_prefix)
+
+        return commands
+
     def _get_owner(self, voice=False):
         if voice:
             for server in self.servers:
@@ -140,6 +243,115 @@ class MusicBot(discord.Client):
 
         return True
 
+    def _audio_cache_in_use(self):
+        """
+            Returns the files that are playing or queued to be played on any server.
+        """
+        in_use = set()
+
+        for player in self.players.values():
+            if player.current_entry:
+                in_use.add(player.current_entry.filename)
+
+            in_use.update(e.filename for e in player.playlist.entries if e.filename)
+
+        return in_use
+
+    async def _audio_cache_eviction_loop(self, interval=600):
+        while True:
+            try:
+                await self.downloader.audio_cache.evict(protected=self._audio_cache_in_use())
+            except Exception:
+                traceback.print_exc()
+                print("[AudioCache] Error al limpiar el caché de música")
+
+            await asyncio.sleep(interval)
+
+    def _journal_records(self):
+        """
+            Returns the journal records for whatever changed since last time: a full snapshot of queues that
+            changed, and just the position for servers where only that moved.
+        """
+        records = []
+
+        for server_id, player in self.players.items():
+            entries = list(player.playlist.entries)
+            current = player.current_entry
+
+            # Cheap to compare, so the queue only gets serialized when it actually changed
+            key = (player.voice_client.channel.id, id(current), tuple(map(id, entries)))
+            position = round(player.position) if current else 0
+            last_key, last_position = self._journaled.get(server_id, (None, None))
+
+            if key != last_key:
+                records.append(QueueJournal.queue_record(server_id, {
+                    'voice_channel': player.voice_client.channel.id,
+                    'current': current.serialize() if current else None,
+                    'entries': [e.serialize() for e in entries]
+                }))
+
+            if position and (key != last_key or position != last_position):
+                records.append(QueueJournal.position_record(server_id, position))
+
+            self._journaled[server_id] = (key, position)
+
+        return records
+
+    def save_queues(self):
+        if self.queue_journal:
+            self.queue_journal.write(self._journal_records())
+
+    def _forget_queue(self, server_id):
+        if self.queue_journal:
+            self._journaled.pop(server_id, None)
+            self.queue_journal.write([QueueJournal.queue_record(server_id, None)])
+
+    async def _queue_journal_loop(self, interval=10):
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                records = self._journal_records()
+
+                if records:
+                    await self.loop.run_in_executor(None, self.queue_journal.write, records)
+
+            except Exception:
+                traceback.print_exc()
+                print("[QueueJournal] Error al guardar las colas")
+
+    async def _restore_queues(self):
+        """
+            Rejoins the voice channels from the journal and puts their queues back, picking up the song that was
+            playing where it left off.  Entries are rebuilt from what was saved, so nothing gets extracted again.
+        """
+        for server_id, state in self.queue_journal.load().items():
+            channel = self.get_channel(state['voice_channel'])
+
+            if not channel or server_id in self.players:
+                continue
+
+            try:
+                player = await self.get_player(channel, create=True)
+            except Exception:
+                if self.config.debug_mode:
+                    traceback.print_exc()
+                print("No se pudo restaurar la cola de", channel.server.name)
+                continue
+
+            current = URLPlaylistEntry.deserialize(player.playlist, state['current']) if state['current'] else None
+            entries = [URLPlaylistEntry.deserialize(player.playlist, data) for data in state['entries']]
+            entries = [e for e in entries if e]
+
+            if current:
+                player.resume_at(current, state['position'])
+                entries.insert(0, current)
+
+            if entries:
+                player.playlist.restore(entries)
+                player.play()
+                self.safe_print("Restaurada la cola de %s (%s canciones)" % (channel.server.name, len(entries)))
+
     # TODO: autosummon option to a specific channel
     async def _auto_summon(self):
         owner = self._get_owner(voice=True)
@@ -255,6 +467,7 @@ class MusicBot(discord.Client):
                     print("Intentando conexión...")
                     await asyncio.wait_for(voice_client.connect(), timeout=10, loop=self.loop)
                     print("Conexión establecida.")
+                    self.voice_supervisor.watch(voice_client)
                     break
                 except:
                     traceback.print_exc()
@@ -285,44 +498,57 @@ class MusicBot(discord.Client):
         await self._update_voice_state(channel)
 
     async def reconnect_voice_client(self, server):
-        if server.id not in self.the_voice_clients:
+        vc = self.the_voice_clients.pop(server.id, None)
+        player = self.players.get(server.id, None)
+
+        if not vc and not player:
             return
 
-        vc = self.the_voice_clients.pop(server.id)
-        _paused = False
+        # A previous attempt may have failed halfway, in which case the player still knows where it was
+        channel = vc.channel if vc else player.voice_client.channel
+        ssd = self.server_specific_data[server]
 
-        player = None
-        if server.id in self.players:
-            player = self.players[server.id]
-            if player.is_playing:
-                player.pause()
-                _paused = True
+        if player and player.is_playing:
+            player.pause()
+            ssd['reconnect_paused'] = True
 
-        try:
-            await vc.disconnect()
-        except:
-            print("Error al desconectarse durante la conexión")
-            traceback.print_exc()
+        if vc:
+            try:
+                await vc.disconnect()
+            except:
+                print("Error al desconectarse durante la conexión")
+                traceback.print_exc()
 
-        await asyncio.sleep(0.1)
+            await asyncio.sleep(0.1)
 
         if player:
-            new_vc = await self.get_voice_client(vc.channel)
+            new_vc = await self.get_voice_client(channel)
             player.reload_voice(new_vc)
 
-            if player.is_paused and _paused:
+            if player.is_paused and ssd['reconnect_paused']:
                 player.resume()
 
+            ssd['reconnect_paused'] = False
+
     async def disconnect_voice_client(self, server):
         if server.id not in self.the_voice_clients:
             return
 
+        self.voice_supervisor.forget(server.id)
+
         if server.id in self.players:
             self.players.pop(server.id).kill()
 
         await self.the_voice_clients.pop(server.id).disconnect()
 
     async def disconnect_all_voice_clients(self):
+        # Shutting down or restarting, so this is what we'll come back to
+        try:
+            self.save_queues()
+        except Exception:
+            traceback.print_exc()
+            print("[QueueJournal] Error al guardar las colas")
+
         for vc in self.the_voice_clients.copy().values():
             await self.disconnect_voice_client(vc.channel.server)
 
@@ -568,7 +794,16 @@ class MusicBot(discord.Client):
                 raise self.exit_signal
 
     async def logout(self):
+        self.voice_supervisor.stop()
         await self.disconnect_all_voice_clients()
+
+        try:
+            self.downloader.save_info_cache()
+        except Exception:
+            traceback.print_exc()
+            print("No se pudo guardar el caché de información")
+
+        self.downloader.shutdown()
         return await super().logout()
 
     async def on_error(self, event, *args, **kwargs):
@@ -700,6 +935,21 @@ class MusicBot(discord.Client):
             else:
                 print("No se pudo eliminar el caché de música, moviéndose.")
 
+        self.voice_supervisor.start()
+
+        # Index whatever is left in the audio cache in the background
+        asyncio.ensure_future(self.downloader.audio_cache.wait_ready())
+
+        if self.config.save_videos and (self.config.audio_cache_max_size or self.config.audio_cache_max_age):
+            if not self.audio_cache_evictor:
+                self.audio_cache_evictor = self.loop.create_task(self._audio_cache_eviction_loop())
+
+        if self.queue_journal:
+            await self._restore_queues()
+
+            if not self.queue_journaler:
+                self.queue_journaler = self.loop.create_task(self._queue_journal_loop())
+
         if self.config.autojoin_channels:
             await self._autojoin_channels(autojoin_channels)
 
@@ -731,11 +981,11 @@ class MusicBot(discord.Client):
         """
 
         if command:
-            cmd = getattr(self, 'cmd_' + command, None)
+            cmd = self.commands.get(command.lower(), None)
             if cmd:
                 return Response(
                     "```\n{}```".format(
-                        dedent(cmd.__doc__),
+                        dedent(cmd.handler.__doc__),
                         command_prefix=self.config.command_prefix
                     ),
                     delete_after=60
@@ -747,9 +997,8 @@ class MusicBot(discord.Client):
             helpmsg = "**Comandos**\n```"
             commands = []
 
-            for att in dir(self):
-                if att.startswith('cmd_') and att != 'cmd_help':
-                    command_name = att.replace('cmd_', '').lower()
+            for command_name in self.commands:
+                if command_name != 'help':
                     commands.append("{}{}".format(self.config.command_prefix, command_name))
 
             helpmsg += ", ".join(commands)
@@ -968,7 +1217,7 @@ class MusicBot(discord.Client):
             if permissions.max_song_length:
                 for e in entry_list.copy():
                     if e.duration > permissions.max_song_length:
-                        player.playlist.entries.remove(e)
+                        player.playlist.remove(e)
                         entry_list.remove(e)
                         drop_count += 1
                         # Im pretty sure there's no situation where this would ever break
@@ -1056,7 +1305,8 @@ class MusicBot(discord.Client):
         if extractor_type == 'youtube:playlist':
             try:
                 entries_added = await player.playlist.async_process_youtube_playlist(
-                    playlist_url, channel=channel, author=author)
+                    playlist_url, max_song_length=permissions.max_song_length, max_songs=permissions.max_songs,
+                    channel=channel, author=author)
                 # TODO: Add hook to be called after each song
                 # TODO: Add permissions
 
@@ -1067,7 +1317,8 @@ class MusicBot(discord.Client):
         elif extractor_type.lower() in ['soundcloud:set', 'bandcamp:album']:
             try:
                 entries_added = await player.playlist.async_process_sc_bc_playlist(
-                    playlist_url, channel=channel, author=author)
+                    playlist_url, max_song_length=permissions.max_song_length, max_songs=permissions.max_songs,
+                    channel=channel, author=author)
                 # TODO: Add hook to be called after each song
                 # TODO: Add permissions
 
@@ -1076,29 +1327,8 @@ class MusicBot(discord.Client):
                 raise exceptions.CommandError('Error al manipular la lista de reproducción %s enlistadas.' % playlist_url, expire_in=30)
 
 
+        # Songs over the max length are already filtered out while processing the playlist
         songs_processed = len(entries_added)
-        drop_count = 0
-        skipped = False
-
-        if permissions.max_song_length:
-            for e in entries_added.copy():
-                if e.duration > permissions.max_song_length:
-                    try:
-                        player.playlist.entries.remove(e)
-                        entries_added.remove(e)
-                        drop_count += 1
-                    except:
-                        pass
-
-            if drop_count:
-                print("Dropeadas %s canciones" % drop_count)
-
-            if player.current_entry and player.current_entry.duration > permissions.max_song_length:
-                await self.safe_delete_message(self.server_specific_data[channel.server]['last_np_msg'])
-                self.server_specific_data[channel.server]['last_np_msg'] = None
-                skipped = True
-                player.skip()
-                entries_added.pop()
 
         await self.safe_delete_message(busymsg)
 
@@ -1120,9 +1350,6 @@ class MusicBot(discord.Client):
 
         if not songs_added:
             basetext = "Ningunas canciones fueron agregadas, todas las canciones fueron sobre la duración máxima (%ss)" % permissions.max_song_length
-            if skipped:
-                basetext += "\nAdemás, la canción actual se omitió por ser demasiado larga."
-
             raise exceptions.CommandError(basetext, expire_in=30)
 
         return Response("Enlistadas {} canciones para ser reproducidas en {} segundos".format(
@@ -1131,7 +1358,7 @@ class MusicBot(discord.Client):
     async def cmd_search(self, player, channel, author, permissions, leftover_args):
         """
         Uso:
-            {prefijo}search [servicio] [número] búsqueda
+            {command_prefix}search [servicio] [número] búsqueda
 
         Busca un servicio para un video y lo agrega a la cola.
         - Servicio: cualquiera de los siguientes servicios:
@@ -1391,6 +1618,42 @@ class MusicBot(discord.Client):
         player.playlist.clear()
         return Response(':put_litter_in_its_place:', delete_after=20)
 
+    async def cmd_seek(self, player, position):
+        """
+        Uso:
+            {command_prefix}seek [+|-]posición
+
+        Salta a una posición de la canción actual, por ejemplo 1:30 o 90.
+        Poniendo + o - antes de la posición hará que salte en relación con la posición actual.
+        """
+
+        if not player.current_entry:
+            raise exceptions.CommandError('¡No se está reproduciendo nada!', expire_in=20)
+
+        relative = position[0] in '+-'
+
+        try:
+            seconds = parse_timestamp(position[1:] if relative else position)
+        except ValueError:
+            raise exceptions.CommandError('{} no es una posición válida'.format(position), expire_in=20)
+
+        if relative:
+            seconds = player.position + (seconds if position[0] == '+' else -seconds)
+
+        entry = player.current_entry
+
+        if not entry.is_downloaded and not entry.stream_url:
+            # Streamed songs are opened again from their url, which may have expired since the song started
+            await entry.resolve_stream_url()
+
+            if player.current_entry is not entry:
+                raise exceptions.CommandError('La canción terminó antes de poder saltar', expire_in=20)
+
+        player.seek(seconds)
+
+        song_progress = str(timedelta(seconds=player.progress)).lstrip('0').lstrip(':')
+        return Response('Saltando a `%s`' % song_progress, delete_after=20)
+
     async def cmd_skip(self, player, channel, author, message, permissions, voice_channel):
         """
         Uso:
@@ -1513,7 +1776,7 @@ class MusicBot(discord.Client):
 
         lines = []
         unlisted = 0
-        andmoretext = '* ... y %s más*' % ('x' * len(player.playlist.entries))
+        andmoretext = '* ... y %s más*' % ('x' * len(str(len(player.playlist))))
 
         if player.current_entry:
             song_progress = str(timedelta(seconds=player.progress)).lstrip('0').lstrip(':')
@@ -1526,20 +1789,21 @@ class MusicBot(discord.Client):
             else:
                 lines.append("Ahora reproduciendo: **%s** %s\n" % (player.current_entry.title, prog_str))
 
+        currentlinesum = sum(len(x) + 1 for x in lines)  # +1 is for newline char
+
         for i, item in enumerate(player.playlist, 1):
             if item.meta.get('canal', False) and item.meta.get('author', False):
                 nextline = '`{}.` **{}** añadido por **{}**'.format(i, item.title, item.meta['author'].name).strip()
             else:
                 nextline = '`{}.` **{}**'.format(i, item.title).strip()
 
-            currentlinesum = sum(len(x) + 1 for x in lines)  # +1 is for newline char
-
             if currentlinesum + len(nextline) + len(andmoretext) > DISCORD_MSG_CHAR_LIMIT:
-                if currentlinesum + len(andmoretext):
-                    unlisted += 1
-                    continue
+                # Stop at the first song that doesn't fit instead of going through the rest of a long queue
+                unlisted = len(player.playlist) - i + 1
+                break
 
             lines.append(nextline)
+            currentlinesum += len(nextline) + 1
 
         if unlisted:
             lines.append('\n*... y %s más*' % unlisted)
@@ -1800,6 +2064,7 @@ class MusicBot(discord.Client):
 
     async def cmd_disconnect(self, server):
         await self.disconnect_voice_client(server)
+        self._forget_queue(server.id)
         return Response(":hear_no_evil:", delete_after=20)
 
     async def cmd_restart(self, channel):
@@ -1829,8 +2094,8 @@ class MusicBot(discord.Client):
         command, *args = message_content.split()  # Uh, doesn't this break prefixes with spaces in them (it doesn't, config parser already breaks them)
         command = command[len(self.config.command_prefix):].lower().strip()
 
-        handler = getattr(self, 'cmd_%s' % command, None)
-        if not handler:
+        command_spec = self.commands.get(command, None)
+        if not command_spec:
             return
 
         if message.channel.is_private:
@@ -1847,59 +2112,11 @@ class MusicBot(discord.Client):
 
         user_permissions = self.permissions.for_user(message.author)
 
-        argspec = inspect.signature(handler)
-        params = argspec.parameters.copy()
-
         # noinspection PyBroadException
         try:
             if user_permissions.ignore_non_voice and command in user_permissions.ignore_non_voice:
                 await self._check_ignore_non_voice(message)
 
-            handler_kwargs = {}
-            if params.pop('message', None):
-                handler_kwargs['message'] = message
-
-            if params.pop('channel', None):
-                handler_kwargs['channel'] = message.channel
-
-            if params.pop('author', None):
-                handler_kwargs['author'] = message.author
-
-            if params.pop('server', None):
-                handler_kwargs['server'] = message.server
-
-            if params.pop('player', None):
-                handler_kwargs['player'] = await self.get_player(message.channel)
-
-            if params.pop('permissions', None):
-                handler_kwargs['permissions'] = user_permissions
-
-            if params.pop('user_mentions', None):
-                handler_kwargs['user_mentions'] = list(map(message.server.get_member, message.raw_mentions))
-
-            if params.pop('channel_mentions', None):
-                handler_kwargs['channel_mentions'] = list(map(message.server.get_channel, message.raw_channel_mentions))
-
-            if params.pop('voice_channel', None):
-                handler_kwargs['voice_channel'] = message.server.me.voice_channel
-
-            if params.pop('leftover_args', None):
-                handler_kwargs['leftover_args'] = args
-
-            args_expected = []
-            for key, param in list(params.items()):
-                doc_key = '[%s=%s]' % (key, param.default) if param.default is not inspect.Parameter.empty else key
-                args_expected.append(doc_key)
-
-                if not args and param.default is not inspect.Parameter.empty:
-                    params.pop(key)
-                    continue
-
-                if args:
-                    arg_value = args.pop(0)
-                    handler_kwargs[key] = arg_value
-                    params.pop(key)
-
             if message.author.id != self.config.owner_id:
                 if user_permissions.command_whitelist and command not in user_permissions.command_whitelist:
                     raise exceptions.PermissionsError(
@@ -1911,24 +2128,14 @@ class MusicBot(discord.Client):
                         "Este comando está deshabilitado para su grupo (%s)." % user_permissions.name,
                         expire_in=20)
 
-            if params:
-                docs = getattr(handler, '__doc__', None)
-                if not docs:
-                    docs = 'Uso: {}{} {}'.format(
-                        self.config.command_prefix,
-                        command,
-                        ' '.join(args_expected)
-                    )
-
-                docs = '\n'.join(l.strip() for l in docs.split('\n'))
-                await self.safe_send_message(
-                    message.channel,
-                    '```\n%s\n```' % docs.format(command_prefix=self.config.command_prefix),
-                    expire_in=60
-                )
+            if len(args) < command_spec.min_args:
+                await self.safe_send_message(message.channel, command_spec.usage, expire_in=60)
                 return
 
-            response = await handler(**handler_kwargs)
+            player = await self.get_player(message.channel) if command_spec.wants_player else None
+            handler_kwargs = command_spec.bind(args, message, user_permissions, player)
+
+            response = await command_spec.handler(**handler_kwargs)
             if response and isinstance(response, Response):
                 content = response.content
                 if response.reply:
@@ -2009,7 +2216,14 @@ class MusicBot(discord.Client):
         if before.region != after.region:
             self.safe_print("[Servidores] \"%s\" regiones cambiadas: %s -> %s" % (after.name, before.region, after.region))
 
-            await self.reconnect_voice_client(after)
+            self.voice_supervisor.notify(after.id, force=True)
+
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.permissions.invalidate(after.id)
+
+    async def on_member_remove(self, member):
+        self.permissions.invalidate(member.id)
 
 
 if __name__ == '__main__':
@@ -78,9 +78,35 @@ class Config:
         self.delete_messages  = config.getboolean('MusicBot', 'DeleteMessages', fallback=ConfigDefaults.delete_messages)
         self.delete_invoking = config.getboolean('MusicBot', 'DeleteInvoking', fallback=ConfigDefaults.delete_invoking)
         self.debug_mode = config.getboolean('MusicBot', 'DebugMode', fallback=ConfigDefaults.debug_mode)
+        self.info_cache_size = config.getint('MusicBot', 'InfoCacheSize', fallback=ConfigDefaults.info_cache_size)
+        self.info_cache_ttl = config.getint('MusicBot', 'InfoCacheTTL', fallback=ConfigDefaults.info_cache_ttl)
+        self.audio_cache_max_size = config.getint('MusicBot', 'AudioCacheMaxSize', fallback=ConfigDefaults.audio_cache_max_size)
+        self.audio_cache_max_age = config.getfloat('MusicBot', 'AudioCacheMaxAge', fallback=ConfigDefaults.audio_cache_max_age)
+        self.metadata_workers = config.getint('MusicBot', 'MetadataWorkers', fallback=ConfigDefaults.metadata_workers)
+        self.download_workers = config.getint('MusicBot', 'DownloadWorkers', fallback=ConfigDefaults.download_workers)
+        self.prefetch_workers = config.getint('MusicBot', 'PrefetchWorkers', fallback=ConfigDefaults.prefetch_workers)
+        self.extractor_concurrency = config.get('MusicBot', 'ExtractorConcurrency', fallback=ConfigDefaults.extractor_concurrency)
+        self.playlist_concurrency = config.getint('MusicBot', 'PlaylistConcurrency', fallback=ConfigDefaults.playlist_concurrency)
+        self.extraction_backend = config.get('MusicBot', 'ExtractionBackend', fallback=ConfigDefaults.extraction_backend)
+        self.extraction_worker_max_jobs = config.getint('MusicBot', 'ExtractionWorkerMaxJobs', fallback=ConfigDefaults.extraction_worker_max_jobs)
+        self.metadata_timeout = config.getint('MusicBot', 'MetadataTimeout', fallback=ConfigDefaults.metadata_timeout)
+        self.download_timeout = config.getint('MusicBot', 'DownloadTimeout', fallback=ConfigDefaults.download_timeout)
+        self.stream_mode = config.getboolean('MusicBot', 'StreamMode', fallback=ConfigDefaults.stream_mode)
+        self.stream_tee_cache = config.getboolean('MusicBot', 'StreamTeeCache', fallback=ConfigDefaults.stream_tee_cache)
+        self.prefetch_count = config.getint('MusicBot', 'PrefetchCount', fallback=ConfigDefaults.prefetch_count)
+        self.prefetch_max_size = config.getint('MusicBot', 'PrefetchMaxSize', fallback=ConfigDefaults.prefetch_max_size)
+        self.prefetch_max_time = config.getint('MusicBot', 'PrefetchMaxTime', fallback=ConfigDefaults.prefetch_max_time)
+        self.normalize_volume = config.getboolean('MusicBot', 'NormalizeVolume', fallback=ConfigDefaults.normalize_volume)
+        self.normalization_target = config.getfloat('MusicBot', 'NormalizationTarget', fallback=ConfigDefaults.normalization_target)
+        self.opus_cache = config.getboolean('MusicBot', 'OpusCache', fallback=ConfigDefaults.opus_cache)
+        self.gapless_playback = config.getboolean('MusicBot', 'GaplessPlayback', fallback=ConfigDefaults.gapless_playback)
+        self.crossfade = config.getfloat('MusicBot', 'Crossfade', fallback=ConfigDefaults.crossfade)
+        self.persistent_queue = config.getboolean('MusicBot', 'PersistentQueue', fallback=ConfigDefaults.persistent_queue)
 
         self.blacklist_file = config.get('Files', 'BlacklistFile', fallback=ConfigDefaults.blacklist_file)
         self.auto_playlist_file = config.get('Files', 'AutoPlaylistFile', fallback=ConfigDefaults.auto_playlist_file)
+        self.info_cache_file = config.get('Files', 'InfoCacheFile', fallback=ConfigDefaults.info_cache_file)
+        self.queue_file = config.get('Files', 'QueueFile', fallback=ConfigDefaults.queue_file)
 
         self.run_checks()
 
@@ -155,6 +181,33 @@ class Config:
 
         self.delete_invoking = self.delete_invoking and self.delete_messages
 
+        if self.extractor_concurrency:
+            limits = {}
+            for item in self.extractor_concurrency.replace(',', ' ').split():
+                try:
+                    name, limit = item.split('=')
+                    limits[name.strip().lower()] = int(limit)
+                except ValueError:
+                    print("[Advertencia] Valor inválido \"%s\" en ExtractorConcurrency, ignorándolo" % item)
+
+            self.extractor_concurrency = limits
+        else:
+            self.extractor_concurrency = {}
+
+        for option in ('metadata_workers', 'download_workers', 'prefetch_workers'):
+            if getattr(self, option) < 1:
+                print("[Advertencia] %s debe ser al menos 1, usando el valor por defecto" % option)
+                setattr(self, option, getattr(ConfigDefaults, option))
+
+        self.extraction_backend = self.extraction_backend.strip().lower()
+        if self.extraction_backend not in ('thread', 'process'):
+            print("[Advertencia] ExtractionBackend debe ser \"thread\" o \"process\", usando \"%s\"" % ConfigDefaults.extraction_backend)
+            self.extraction_backend = ConfigDefaults.extraction_backend
+
+        if self.crossfade < 0:
+            print("[Advertencia] Crossfade no puede ser negativo, deshabilitándolo")
+            self.crossfade = 0.0
+
         self.bound_channels = set(item.replace(',', ' ').strip() for item in self.bound_channels)
 
         self.autojoin_channels = set(item.replace(',', ' ').strip() for item in self.autojoin_channels)
@@ -187,10 +240,36 @@ class ConfigDefaults:
     delete_messages = True
     delete_invoking = False
     debug_mode = False
+    info_cache_size = 2000
+    info_cache_ttl = 3600
+    audio_cache_max_size = 0
+    audio_cache_max_age = 0
+    metadata_workers = 2
+    download_workers = 2
+    prefetch_workers = 3
+    extractor_concurrency = {}
+    playlist_concurrency = 4
+    extraction_backend = 'thread'
+    extraction_worker_max_jobs = 50
+    metadata_timeout = 60
+    download_timeout = 600
+    stream_mode = False
+    stream_tee_cache = True
+    prefetch_count = 3
+    prefetch_max_size = 100
+    prefetch_max_time = 900
+    normalize_volume = False
+    normalization_target = -16.0
+    opus_cache = False
+    gapless_playback = True
+    crossfade = 0.0
+    persistent_queue = True
 
     options_file = 'config/options.ini'
     blacklist_file = 'config/blacklist.txt'
     auto_playlist_file = 'config/autoplaylist.txt' # this will change when I add playlists
+    info_cache_file = 'data/info_cache.json'
+    queue_file = 'data/queue.journal'
 
 # These two are going to be wrappers for the id lists, with add/remove/load/save functions
 # and id/object conversion so types aren't an issue
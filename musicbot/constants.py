@@ -6,3 +6,6 @@ VERSION = MAIN_VERSION + SUB_VERSION
 
 AUDIO_CACHE_PATH = os.path.join(os.getcwd(), 'audio_cache')
 DISCORD_MSG_CHAR_LIMIT = 2000
+
+# What ffmpeg sends us: 48kHz * 16 bit samples * 2 channels
+PCM_BYTES_PER_SECOND = 48000 * 2 * 2
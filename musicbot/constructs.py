@@ -1,12 +1,13 @@
 import json
 import pydoc
+import struct
 import inspect
 import logging
+import functools
 
 import discord
 
 from enum import Enum
-from discord.ext.commands.bot import _get_variable
 from .utils import objdiff
 
 log = logging.getLogger(__name__)
@@ -70,37 +71,67 @@ class Serializer(json.JSONEncoder):
         return super().default(o)
 
     @classmethod
-    def deserialize(cls, data):
+    def deserialize(cls, data, **context):
+        """
+            Turns an enclosed object back into its class, for use as a json object hook.  Whatever a class's
+            `_deserialize` needs besides the data (e.g. the playlist of an entry) is taken from `context`.
+        """
         if all(x in data for x in Serializable._class_signature):
-            # log.debug("Deserialization requested for %s", data)
-            factory = pydoc.locate(data['__module__'] + '.' + data['__class__'])
-            # log.debug("Found object %s", factory)
-            if factory and issubclass(factory, Serializable):
-                # log.debug("Deserializing %s object", factory)
-                return factory._deserialize(data['data'], **cls._get_vars(factory._deserialize))
+            factory = Serializable.lookup(data['__module__'], data['__class__'])
+
+            if factory:
+                return factory._deserialize(data['data'], **factory._context_from(context))
 
         return data
 
     @classmethod
-    def _get_vars(cls, func):
-        # log.debug("Getting vars for %s", func)
-        params = inspect.signature(func).parameters.copy()
-        args = {}
-        # log.debug("Got %s", params)
+    def object_hook(cls, **context):
+        return functools.partial(cls.deserialize, **context)
 
-        for name, param in params.items():
-            # log.debug("Checking arg %s, type %s", name, param.kind)
-            if param.kind is param.POSITIONAL_OR_KEYWORD and param.default is None:
-                # log.debug("Using var %s", name)
-                args[name] = _get_variable(name)
-                # log.debug("Collected var for arg '%s': %s", name, args[name])
 
-        return args
+class _SerializableMeta(type):
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        cls._registry[(cls.__module__, cls.__qualname__)] = cls
+        cls._context_args = None
 
 
-class Serializable:
+class Serializable(metaclass=_SerializableMeta):
     _class_signature = ('__class__', '__module__', 'data')
 
+    # Every subclass by (module, qualname), filled in as they're defined
+    _registry = {}
+
+    @classmethod
+    def lookup(cls, module, qualname):
+        """
+            Returns the Serializable class called `qualname` in `module`, or None.  Classes from modules that
+            haven't been imported yet are located once and remembered, misses included.
+        """
+        key = (module, qualname)
+
+        try:
+            return cls._registry[key]
+        except KeyError:
+            pass
+
+        factory = pydoc.locate(module + '.' + qualname)
+        if not (isinstance(factory, type) and issubclass(factory, Serializable)):
+            factory = None
+
+        cls._registry[key] = factory
+        return factory
+
+    @classmethod
+    def _context_from(cls, context):
+        if cls._context_args is None:
+            # The arguments of _deserialize defaulting to None are the ones it needs from the context
+            params = inspect.signature(cls._deserialize).parameters.values()
+            cls._context_args = tuple(
+                p.name for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY) and p.default is None)
+
+        return {name: context.get(name, None) for name in cls._context_args}
+
     def _enclose_json(self, data):
         return {
             '__class__': self.__class__.__qualname__,
@@ -116,6 +147,10 @@ class Serializable:
     def serialize(self, *, cls=Serializer, **kwargs):
         return json.dumps(self, cls=cls, **kwargs)
 
+    @staticmethod
+    def deserialize(raw_json, **context):
+        return json.loads(raw_json, object_hook=Serializer.object_hook(**context))
+
     def __json__(self):
         raise NotImplementedError
 
@@ -124,6 +159,292 @@ class Serializable:
         raise NotImplementedError
 
 
+# A compact binary form of the json data model, along the lines of msgpack.  Every value starts with a one byte
+# tag, followed by varint lengths and the payload.  Short strings are numbered the first time they show up in a
+# value and referenced by number after that, so the keys repeated in every entry of a big queue cost a byte or two.
+# Serializable objects keep their class but drop the json envelope.
+
+_NONE, _FALSE, _TRUE, _INT, _NEG_INT, _FLOAT, _STR, _STR_REF, _BYTES, _LIST, _DICT, _OBJECT = range(12)
+
+_DOUBLE = struct.Struct('<d')
+_MAX_SHARED_STRING = 64
+
+
+class IncompleteData(ValueError):
+    pass
+
+
+def _pack_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+
+    out.append(n)
+
+
+class _Packer:
+    __slots__ = ['out', 'strings']
+
+    def __init__(self):
+        self.out = bytearray()
+        self.strings = {}
+
+    def pack_str(self, s):
+        out = self.out
+        index = self.strings.get(s, None)
+
+        if index is not None:
+            out.append(_STR_REF)
+            _pack_varint(out, index)
+            return
+
+        data = s.encode('utf8')
+        out.append(_STR)
+        _pack_varint(out, len(data))
+        out += data
+
+        if len(data) <= _MAX_SHARED_STRING:
+            self.strings[s] = len(self.strings)
+
+    def pack(self, obj):
+        out = self.out
+
+        if obj is None:
+            out.append(_NONE)
+
+        elif obj is True:
+            out.append(_TRUE)
+
+        elif obj is False:
+            out.append(_FALSE)
+
+        elif isinstance(obj, str):
+            self.pack_str(obj)
+
+        elif isinstance(obj, int):
+            if obj >= 0:
+                out.append(_INT)
+                _pack_varint(out, obj)
+            else:
+                out.append(_NEG_INT)
+                _pack_varint(out, -obj)
+
+        elif isinstance(obj, float):
+            out.append(_FLOAT)
+            out += _DOUBLE.pack(obj)
+
+        elif isinstance(obj, dict):
+            out.append(_DICT)
+            _pack_varint(out, len(obj))
+
+            for key, value in obj.items():
+                self.pack(key)
+                self.pack(value)
+
+        elif isinstance(obj, (list, tuple)):
+            out.append(_LIST)
+            _pack_varint(out, len(obj))
+
+            for item in obj:
+                self.pack(item)
+
+        elif isinstance(obj, (bytes, bytearray)):
+            out.append(_BYTES)
+            _pack_varint(out, len(obj))
+            out += obj
+
+        elif hasattr(obj, '__json__'):
+            enclosed = obj.__json__()
+            out.append(_OBJECT)
+            self.pack_str(enclosed['__module__'])
+            self.pack_str(enclosed['__class__'])
+            self.pack(enclosed['data'])
+
+        else:
+            raise TypeError("Object of type %s is not serializable" % type(obj).__name__)
+
+
+def pack(obj):
+    """
+        Encodes `obj` to bytes.  The result of several calls can be written one after the other and read back
+        with `Unpacker`.
+    """
+    packer = _Packer()
+    packer.pack(obj)
+    return bytes(packer.out)
+
+
+class _Unpacker:
+    __slots__ = ['buf', 'pos', 'strings', 'context']
+
+    def __init__(self, buf, pos, context):
+        self.buf = buf
+        self.pos = pos
+        self.strings = []
+        self.context = context
+
+    def take(self, size):
+        end = self.pos + size
+        if end > len(self.buf):
+            raise IncompleteData("Data ends in the middle of a value")
+
+        data = self.buf[self.pos:end]
+        self.pos = end
+        return data
+
+    def varint(self):
+        buf = self.buf
+        n = shift = 0
+
+        while True:
+            if self.pos >= len(buf):
+                raise IncompleteData("Data ends in the middle of a value")
+
+            byte = buf[self.pos]
+            self.pos += 1
+            n |= (byte & 0x7f) << shift
+
+            if byte < 0x80:
+                return n
+
+            shift += 7
+
+    def string(self):
+        data = self.take(self.varint())
+        s = data.decode('utf8')
+
+        if len(data) <= _MAX_SHARED_STRING:
+            self.strings.append(s)
+
+        return s
+
+    def unpack(self):
+        if self.pos >= len(self.buf):
+            raise IncompleteData("Data ends in the middle of a value")
+
+        tag = self.buf[self.pos]
+        self.pos += 1
+
+        if tag == _STR_REF:
+            index = self.varint()
+            try:
+                return self.strings[index]
+            except IndexError:
+                raise ValueError("Reference to unknown string %s" % index) from None
+
+        elif tag == _STR:
+            return self.string()
+
+        elif tag == _DICT:
+            # Not a comprehension, older pythons evaluate the value before the key in those
+            obj = {}
+            for _ in range(self.varint()):
+                key = self.unpack()
+                obj[key] = self.unpack()
+
+            return obj
+
+        elif tag == _LIST:
+            return [self.unpack() for _ in range(self.varint())]
+
+        elif tag == _INT:
+            return self.varint()
+
+        elif tag == _NEG_INT:
+            return -self.varint()
+
+        elif tag == _FLOAT:
+            return _DOUBLE.unpack(self.take(8))[0]
+
+        elif tag == _NONE:
+            return None
+
+        elif tag == _TRUE:
+            return True
+
+        elif tag == _FALSE:
+            return False
+
+        elif tag == _BYTES:
+            return bytes(self.take(self.varint()))
+
+        elif tag == _OBJECT:
+            module = self.unpack()
+            qualname = self.unpack()
+            data = self.unpack()
+
+            factory = Serializable.lookup(module, qualname)
+            if not factory:
+                return {'__class__': qualname, '__module__': module, 'data': data}
+
+            return factory._deserialize(data, **factory._context_from(self.context))
+
+        raise ValueError("Unknown tag %s at byte %s" % (tag, self.pos - 1))
+
+
+def unpack(data, **context):
+    """
+        Decodes a single value encoded by `pack`.  Serializable objects in it are rebuilt with `context`,
+        see `Serializer.deserialize`.
+    """
+    unpacker = _Unpacker(data, 0, context)
+    obj = unpacker.unpack()
+
+    if unpacker.pos != len(data):
+        raise ValueError("Extra data after the value")
+
+    return obj
+
+
+class Unpacker:
+    """
+        Decodes the values written one after the other to a binary file, one at a time as they're iterated over,
+        so a large dump doesn't have to be read into memory first.  A value cut short at the end of the file
+        (e.g. by a crash while it was being written) ends the iteration, and is counted in `truncated`.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fileobj, **context):
+        self.fileobj = fileobj
+        self.context = context
+        self.truncated = 0
+
+    def __iter__(self):
+        buf = b''
+        pos = 0
+        eof = False
+
+        while True:
+            if pos < len(buf):
+                unpacker = _Unpacker(buf, pos, self.context)
+
+                try:
+                    value = unpacker.unpack()
+
+                except IncompleteData:
+                    if eof:
+                        self.truncated += 1
+                        return
+
+                else:
+                    pos = unpacker.pos
+                    yield value
+                    continue
+
+            elif eof:
+                return
+
+            # Either out of data or the next value doesn't fit in what's buffered
+            chunk = self.fileobj.read(max(self.CHUNK_SIZE, len(buf) - pos))
+
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+            else:
+                eof = True
+
+
 class VoiceStateUpdate:
     class Change(Enum):
         RESUME     = 0   # Reconnect to an existing voice session
@@ -1,9 +1,20 @@
 import os
+import re
+import copy
+import time
 import asyncio
 import functools
+import threading
 import youtube_dl
+import urllib.parse
 
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import extractworker
+from .audiocache import AudioCache
+from .exceptions import ExtractionTimeout, DownloadCancelled
 
 ytdl_format_options = {
     'format': 'bestaudio/best',
@@ -32,13 +43,115 @@ youtube_dl.utils.bug_reports_message = lambda: ''
 
 '''
 
+# Extraction work is split into separate pools so a big playlist import can't starve everything else:
+#  - metadata: info lookups for commands (play, search, etc)
+#  - download: downloading the song that's playing next
+#  - prefetch: downloading songs further down the queue and looking up songs from playlist imports
+POOL_NAMES = ('metadata', 'download', 'prefetch')
+DEFAULT_POOL_SIZES = {'metadata': 2, 'download': 2, 'prefetch': 3}
+
+# Where youtube-dl runs: threads in the bot process, or worker processes so extraction doesn't fight the
+# audio threads for the GIL
+EXTRACTION_BACKENDS = ('thread', 'process')
+
+# How long a direct media url is trusted for when it doesn't say when it expires
+DEFAULT_URL_LIFETIME = 20 * 60
+
+# Direct media urls this close to expiring are looked up again instead of being used
+URL_EXPIRY_MARGIN = 60
+
+# Signed urls (googlevideo and the like) carry their expiry time, either as a query parameter or a path segment
+_URL_EXPIRY_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+def url_expiry(info, resolved_at=None):
+    """
+        Returns the timestamp after which the direct media url in a resolved `info` dict can't be used anymore.
+    """
+    match = _URL_EXPIRY_RE.search(info.get('url', None) or '')
+    if match:
+        return int(match.group(1))
+
+    return (resolved_at or info.get('_resolved_at', None) or time.time()) + DEFAULT_URL_LIFETIME
+
+
+def urls_expired(info):
+    """
+        Returns True if a resolved `info` dict, or any resolved entry of a playlist one, has a direct media url
+        that expired or is about to.  Infos that weren't processed don't have one, so they never expire.
+    """
+    infos = info.get('entries', None) if isinstance(info.get('entries', None), list) else [info]
+    now = time.time()
+
+    for item in infos:
+        if isinstance(item, dict) and item.get('url', None) and 'format_id' in item:
+            # Playlist entries don't have their own resolve time
+            if now > url_expiry(item, info.get('_resolved_at', None)) - URL_EXPIRY_MARGIN:
+                return True
+
+    return False
+
+
+class _Flight:
+    __slots__ = ['future', 'joiners', 'waiters']
+
+    def __init__(self, future):
+        self.future = future
+        self.joiners = 0
+        self.waiters = 0
+
+
 class Downloader:
-    def __init__(self, download_folder=None):
-        self.thread_pool = ThreadPoolExecutor(max_workers=2)
+    # How often to check if a job waiting for a worker process got one, see _wait_started
+    START_POLL_INTERVAL = 0.5
+
+    def __init__(self, download_folder=None, info_cache=None, audio_cache_max_size=0, audio_cache_max_age=0,
+                 analyze_loudness=False, pool_sizes=None, extractor_limits=None, backend='thread', worker_max_jobs=0,
+                 metadata_timeout=0, download_timeout=0):
+        pool_sizes = dict(DEFAULT_POOL_SIZES, **(pool_sizes or {}))
+        self.pool_sizes = {name: max(1, pool_sizes[name]) for name in POOL_NAMES}
+        self.thread_pools = {name: ThreadPoolExecutor(max_workers=max(1, pool_sizes[name])) for name in POOL_NAMES}
+        self.thread_pool = self.thread_pools['metadata']
+
+        # Jobs per pool that timed out but are still running in a thread, see _replace_worker
+        self._stuck_jobs = {name: 0 for name in POOL_NAMES}
+
+        # Same split as the thread pools, the processes are only started once they're needed
+        self.process_pools = {
+            name: extractworker.ExtractionProcessPool(max(1, pool_sizes[name]), worker_max_jobs) for name in POOL_NAMES
+        } if backend == 'process' else None
+
+        # Seconds a single job may take before it's given up on, 0 for no limit
+        self.metadata_timeout = metadata_timeout
+        self.download_timeout = download_timeout
+
+        # Max number of concurrent jobs per extractor (youtube, soundcloud, etc), across all pools
+        self.extractor_limits = {k.lower(): v for k, v in (extractor_limits or {}).items() if v > 0}
+        self._extractor_semaphores = defaultdict(lambda: None)
+
+        # Jobs running right now by what they do, so identical requests can wait for the same one
+        self._in_flight = {}
+
+        self.info_cache = info_cache
+        self._info_cache_flush = None
         self.unsafe_ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
         self.safe_ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
         self.safe_ytdl.params['ignoreerrors'] = True
+
+        # Downloads running in threads that nobody wants anymore, see _abort
+        self._job_local = threading.local()
+        self._running_jobs = set()
+        self._aborted = {}
+        self._abort_lock = threading.Lock()
+        self.unsafe_ytdl.add_progress_hook(self._progress_hook)
+        self.safe_ytdl.add_progress_hook(self._progress_hook)
         self.download_folder = download_folder
+        self.audio_cache = AudioCache(
+            download_folder,
+            max_size=audio_cache_max_size,
+            max_age=audio_cache_max_age,
+            analyze_loudness=analyze_loudness
+        ) if download_folder else None
 
         if download_folder:
             otmpl = self.unsafe_ytdl.params['outtmpl']
@@ -53,15 +166,381 @@ class Downloader:
     def ytdl(self):
         return self.safe_ytdl
 
-    async def extract_info(self, loop, *args, on_error=None, retry_on_error=False, **kwargs):
+    def _get_cached_info(self, args, kwargs):
+        """
+            Looks up the info cache for a metadata only extraction. Returns a (url, process, info) tuple,
+            with `url` being None if the call isn't something we can cache.
+        """
+        if not self.info_cache or not self.info_cache.enabled:
+            return None, None, None
+
+        # Only plain `extract_info(url, download=False[, process=...])` calls are cacheable
+        if len(args) != 1 or kwargs.get('download', True) or set(kwargs).difference({'download', 'process'}):
+            return None, None, None
+
+        url, process = args[0], kwargs.get('process', True)
+        info = self.info_cache.get(url, process)
+
+        if info and urls_expired(info):
+            # The rest of it would still be good, but whoever asks for it may be about to use the media url
+            self.info_cache.discard(url, process)
+            info = None
+
+        return url, process, info
+
+    def _cache_info(self, loop, url, process, info):
+        if url is None or not info:
+            return
+
+        self.info_cache.put(url, process, info)
+
+        if self.info_cache.dirty and not self._info_cache_flush:
+            self._info_cache_flush = loop.call_later(30, self._flush_info_cache, loop)
+
+    def _flush_info_cache(self, loop):
+        self._info_cache_flush = None
+
+        if self.info_cache.dirty:
+            loop.run_in_executor(None, self.info_cache.save, self.info_cache.snapshot())
+
+    def save_info_cache(self):
+        if self._info_cache_flush:
+            self._info_cache_flush.cancel()
+            self._info_cache_flush = None
+
+        if self.info_cache and self.info_cache.dirty:
+            self.info_cache.save()
+
+    @staticmethod
+    def _run_extract(ytdl, *args, **kwargs):
+        info = ytdl.extract_info(*args, **kwargs)
+
+        # So whoever ends up with this info, even out of the info cache, knows how fresh its media urls are
+        if isinstance(info, dict):
+            info['_resolved_at'] = time.time()
+
+        # Some extractors hand back a lazy generator for playlist entries which does network requests as
+        # it's consumed.  Materialize it here in the worker thread so that never happens on the event loop.
+        if info and 'entries' in info and not isinstance(info['entries'], list):
+            info['entries'] = list(info['entries'])
+
+        return info
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def guess_extractor(url):
+        """
+            Returns the name of the extractor ytdl would most likely use for `url`, without any network access.
+        """
+        for ie in youtube_dl.extractor.gen_extractor_classes():
+            if ie.ie_key() != 'Generic' and ie.suitable(url):
+                return ie.IE_NAME.split(':')[0].lower()
+
+        return 'generic'
+
+    def _extractor_semaphore(self, loop, extractor):
+        if extractor not in self.extractor_limits:
+            return None
+
+        if not self._extractor_semaphores[extractor]:
+            self._extractor_semaphores[extractor] = asyncio.Semaphore(self.extractor_limits[extractor], loop=loop)
+
+        return self._extractor_semaphores[extractor]
+
+    @staticmethod
+    def normalize_url(url):
+        """
+            Returns `url` in a form where trivially different spellings of the same url compare equal.
+        """
+        url = url.strip()
+        parts = urllib.parse.urlsplit(url)
+
+        # Searches and such aren't urls, leave those alone
+        if not parts.scheme or not parts.netloc:
+            return url
+
+        return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+    async def coalesce(self, loop, key, coro_factory):
+        """
+            Runs the coroutine made by `coro_factory` unless one for `key` is already running, in which case
+            its result is awaited instead.  Results shared between callers are copied for each of them, so
+            they're free to change what they get.  The shared job is only cancelled once every caller waiting
+            for it has been.
+        """
+        flight = self._in_flight.get(key, None)
+        joined = flight is not None
+
+        if joined:
+            flight.joiners += 1
+        else:
+            flight = self._in_flight[key] = _Flight(asyncio.ensure_future(coro_factory(), loop=loop))
+            flight.future.add_done_callback(functools.partial(self._landed, key, flight))
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.future, loop=loop)
+
+        except asyncio.CancelledError:
+            if not flight.waiters - 1 and not flight.future.done():
+                # Anyone asking from now on gets a fresh job instead of this dying one
+                if self._in_flight.get(key, None) is flight:
+                    del self._in_flight[key]
+
+                flight.future.cancel()
+            raise
+
+        finally:
+            flight.waiters -= 1
+
+        return copy.deepcopy(result) if joined or flight.joiners else result
+
+    def _landed(self, key, flight, future):
+        if self._in_flight.get(key, None) is flight:
+            del self._in_flight[key]
+
+        # Nobody might be left waiting for it, don't let asyncio complain about the exception
+        if not future.cancelled():
+            future.exception()
+
+    def _flight_key(self, ytdl, args, kwargs):
+        if len(args) != 1 or not isinstance(args[0], str) or set(kwargs).difference({'download', 'process'}):
+            return None
+
+        operation = 'download' if kwargs.get('download', True) else 'info'
+        return (operation, kwargs.get('process', True), ytdl is self.safe_ytdl, self.normalize_url(args[0]))
+
+    async def _run_in_pool(self, loop, ytdl, args, kwargs, pool=None, extractor=None):
+        """
+            Runs ytdl.extract_info in a pool, sharing the job with any identical one already running.
+        """
+        key = self._flight_key(ytdl, args, kwargs)
+
+        if key is None:
+            return await self._submit(loop, ytdl, args, kwargs, pool, extractor)
+
+        return await self.coalesce(loop, key, lambda: self._submit(loop, ytdl, args, kwargs, pool, extractor))
+
+    async def _submit(self, loop, ytdl, args, kwargs, pool=None, extractor=None):
+        if pool is None:
+            pool = 'download' if kwargs.get('download', True) else 'metadata'
+
+        if self.extractor_limits and not extractor and args and isinstance(args[0], str):
+            extractor = self.guess_extractor(args[0])
+
+        if self.process_pools:
+            func = functools.partial(extractworker.extract_info, self._ytdl_name(ytdl), ytdl.params, args, kwargs)
+        else:
+            func = functools.partial(self._run_extract, ytdl, *args, **kwargs)
+
+        timeout = self.download_timeout if kwargs.get('download', True) else self.metadata_timeout
+        return await self._run_job(loop, func, pool, extractor, timeout)
+
+    def _ytdl_name(self, ytdl):
+        return 'safe' if ytdl is self.safe_ytdl else 'unsafe'
+
+    async def _run_job(self, loop, func, pool, extractor, timeout=0):
+        semaphore = self._extractor_semaphore(loop, extractor.split(':')[0].lower() if extractor else None)
+
+        if semaphore:
+            with await semaphore:
+                return await self._run_with_deadline(loop, func, pool, timeout)
+        else:
+            return await self._run_with_deadline(loop, func, pool, timeout)
+
+    async def _run_with_deadline(self, loop, func, pool, timeout):
+        """
+            Runs `func` in `pool`, giving up on it if it runs for more than `timeout` seconds, or waits that long
+            for a free worker.  A job still waiting is just dropped.  A running job can't be cancelled, so the
+            worker it's stuck in is killed (processes) or left behind (threads) and replaced, and the pool is
+            back to full strength for everyone else.  Only so many threads are left behind per pool, past that
+            a stuck job keeps its worker until it's done.
+        """
+        for attempt in range(2):
+            token = object()
+            started = asyncio.Future(loop=loop)
+
+            if self.process_pools:
+                executor = self.process_pools[pool]
+                job = executor.submit(func)
+            else:
+                executor = self.thread_pools[pool]
+                on_start = functools.partial(loop.call_soon_threadsafe, self._set_started, started)
+                job = executor.submit(self._run_tracked, token, func, on_start)
+
+            future = asyncio.wrap_future(job, loop=loop)
+
+            try:
+                if not timeout:
+                    return await future
+
+                if not await self._wait_started(loop, job, future, started, timeout) and job.cancel():
+                    raise ExtractionTimeout("No hubo un worker libre para youtube-dl en %s segundos" % timeout)
+
+                # The deadline of a running job starts when it got its worker
+                return await asyncio.wait_for(asyncio.shield(future, loop=loop), timeout, loop=loop)
+
+            except asyncio.TimeoutError:
+                # Whatever it ends up doing, nobody is waiting for it anymore
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                self._replace_worker(pool, executor, job, future)
+
+                if not self.process_pools:
+                    # Downloads at least stop at their next progress report
+                    self._abort(token)
+
+                raise ExtractionTimeout("youtube-dl no respondió en %s segundos" % timeout) from None
+
+            except asyncio.CancelledError:
+                # Jobs that haven't started are just dropped, running ones stop at their next progress report
+                if not job.cancel() and not self.process_pools:
+                    self._abort(token)
+                raise
+
+            except BrokenProcessPool:
+                # Most likely killed along with a stuck job in the same pool, which has nothing to do with this one
+                if attempt:
+                    raise
+
+    @staticmethod
+    def _set_started(started):
+        if not started.done():
+            started.set_result(None)
+
+    async def _wait_started(self, loop, job, future, started, timeout):
+        """
+            Waits up to `timeout` seconds for a worker to pick up `job`.  Returns False if none did.
+        """
+        if not self.process_pools:
+            # _run_tracked tells us
+            await asyncio.wait([future, started], timeout=timeout, return_when=asyncio.FIRST_COMPLETED, loop=loop)
+            return started.done() or future.done()
+
+        # Worker processes can't, but a process pool only hands a job over once a worker is about to be free
+        deadline = loop.time() + timeout
+
+        while not (job.running() or job.done()):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+
+            await asyncio.wait([future], timeout=min(remaining, self.START_POLL_INTERVAL), loop=loop)
+
+        return True
+
+    def _run_tracked(self, token, func, on_start):
+        try:
+            on_start()
+        except RuntimeError:
+            # The loop is gone, we're shutting down
+            pass
+
+        self._job_local.token = token
+
+        with self._abort_lock:
+            self._running_jobs.add(token)
+
+        try:
+            return func()
+
+        finally:
+            self._job_local.token = None
+
+            with self._abort_lock:
+                self._running_jobs.discard(token)
+                partial_files = self._aborted.pop(token, None)
+
+            if partial_files:
+                self._delete_partial_files(partial_files)
+
+    def _abort(self, token):
+        """
+            Makes the download of a job stop the next time youtube-dl reports progress.  Only works for jobs
+            running in threads, worker processes finish their downloads regardless.
+        """
+        with self._abort_lock:
+            # A job that already finished won't be around to clean up after itself
+            if token in self._running_jobs:
+                self._aborted[token] = ()
+
+    def _progress_hook(self, status):
+        token = getattr(self._job_local, 'token', None)
+
+        if token is not None and token in self._aborted:
+            # Remember what it was writing to, so it can be deleted once the download is done unwinding
+            self._aborted[token] = (status.get('tmpfilename', None), status.get('filename', None))
+            raise DownloadCancelled("Descarga cancelada: %s" % status.get('filename', None))
+
+    @staticmethod
+    def _delete_partial_files(partial_files):
+        tmpfilename, filename = partial_files
+
+        # Fragmented downloads keep their progress in a .ytdl file next to the song
+        paths = [tmpfilename, filename + '.ytdl' if filename else None]
+
+        for path in paths:
+            if not path:
+                continue
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print("[Descarga] No se pudo eliminar el archivo parcial %s: %s" % (path, e))
+
+    def _replace_worker(self, pool, executor, job, future):
+        if self.process_pools:
+            executor.kill(job)
+            return
+
+        if future.done():
+            return
+
+        self._stuck_jobs[pool] += 1
+        future.add_done_callback(lambda f: self._unstuck(pool))
+
+        # Threads can't be killed, but a fresh pool means the stuck one doesn't take up a worker anymore.  Each
+        # stuck thread is one more than the pool size allows, so once there are as many as that they keep theirs.
+        if self._stuck_jobs[pool] > self.pool_sizes[pool]:
+            print("[Descarga] Demasiados trabajos de youtube-dl atascados en %s, no se reemplazará el worker" % pool)
+            return
+
+        if self.thread_pools[pool] is executor:
+            self.thread_pools[pool] = ThreadPoolExecutor(max_workers=self.pool_sizes[pool])
+            self.thread_pool = self.thread_pools['metadata']
+            executor.shutdown(wait=False)
+
+    def _unstuck(self, pool):
+        self._stuck_jobs[pool] -= 1
+
+    def shutdown(self):
+        """
+            Lets the extraction worker processes exit once they're done with what they're doing.
+        """
+        if self.process_pools:
+            for process_pool in self.process_pools.values():
+                process_pool.shutdown(wait=False)
+
+    async def extract_info(self, loop, *args, on_error=None, retry_on_error=False, pool=None, extractor=None, **kwargs):
         """
             Runs ytdl.extract_info within the threadpool. Returns a future that will fire when it's done.
             If `on_error` is passed and an exception is raised, the exception will be caught and passed to
             on_error as an argument.
+
+            Metadata only extractions are served from the info cache when possible.  `pool` picks which
+            thread pool the job runs in (defaults to "download" for downloads and "metadata" otherwise), and
+            `extractor` is used for the per extractor concurrency limits, guessed from the url if not given.
         """
+        cache_url, process, info = self._get_cached_info(args, kwargs)
+        if info:
+            return info
+
         if callable(on_error):
             try:
-                return await loop.run_in_executor(self.thread_pool, functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs))
+                info = await self._run_in_pool(loop, self.unsafe_ytdl, args, kwargs, pool, extractor)
+                self._cache_info(loop, cache_url, process, info)
+                return info
 
             except Exception as e:
 
@@ -77,9 +556,37 @@ class Downloader:
                     loop.call_soon_threadsafe(on_error, e)
 
                 if retry_on_error:
-                    return await self.safe_extract_info(loop, *args, **kwargs)
+                    return await self.safe_extract_info(loop, *args, pool=pool, extractor=extractor, **kwargs)
+        else:
+            info = await self._run_in_pool(loop, self.unsafe_ytdl, args, kwargs, pool, extractor)
+            self._cache_info(loop, cache_url, process, info)
+            return info
+
+    @staticmethod
+    def _run_process(ytdl, info):
+        ytdl.process_info(info)
+        return info
+
+    async def download_resolved(self, loop, info, *, pool='download', extractor=None):
+        """
+            Downloads a song from an info dict that extract_info already resolved (format chosen, direct url and
+            all), skipping a second extraction.  Returns the info, like extract_info(download=True) would.
+        """
+        if self.extractor_limits and not extractor:
+            extractor = info.get('extractor', None)
+
+        # process_info fills in where the file went and such, leave the caller's copy alone
+        if self.process_pools:
+            func = functools.partial(extractworker.process_info, 'unsafe', self.unsafe_ytdl.params, dict(info))
         else:
-            return await loop.run_in_executor(self.thread_pool, functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs))
+            func = functools.partial(self._run_process, self.unsafe_ytdl, dict(info))
+        return await self._run_job(loop, func, pool, extractor, self.download_timeout)
+
+    async def safe_extract_info(self, loop, *args, pool=None, extractor=None, **kwargs):
+        cache_url, process, info = self._get_cached_info(args, kwargs)
+        if info:
+            return info
 
-    async def safe_extract_info(self, loop, *args, **kwargs):
-        return await loop.run_in_executor(self.thread_pool, functools.partial(self.safe_ytdl.extract_info, *args, **kwargs))
+        info = await self._run_in_pool(loop, self.safe_ytdl, args, kwargs, pool, extractor)
+        self._cache_info(loop, cache_url, process, info)
+        return info
@@ -0,0 +1,239 @@
+import math
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import audioop
+except ImportError:
+    # audioop is gone in newer pythons
+    audioop = None
+
+
+# ffmpeg gives us signed 16 bit little endian pcm
+SAMPLE_MIN = -32768
+SAMPLE_MAX = 32767
+
+
+class GainStage:
+    """
+        Applies a gain to s16le pcm frames.  Clips instead of wrapping around when the result doesn't fit,
+        and ramps from the old gain to the new one over a frame when it changes so there's no audible click.
+
+        This is the slow pure python version, use `create_gain_stage` to get the fastest one available.
+    """
+
+    def __init__(self, gain=1.0, *, max_gain=2.0):
+        self.max_gain = max_gain
+        self.gain = gain
+        self._current = self.gain
+
+    @property
+    def gain(self):
+        return self._target
+
+    @gain.setter
+    def gain(self, value):
+        self._target = max(0.0, min(value, self.max_gain))
+
+    def reset(self):
+        """
+            Jumps straight to the current gain instead of ramping to it on the next frame.
+        """
+        self._current = self._target
+
+    def process(self, frame):
+        if not frame:
+            # The read at the end of a song, nothing to ramp over
+            return frame
+
+        target = self._target
+        start = self._current
+        self._current = target
+
+        if start == target == 1.0:
+            return frame
+
+        return self._apply(frame, start, target)
+
+    def _apply(self, frame, start, target):
+        samples = array('h', frame)
+        count = len(samples)
+        step = (target - start) / count if count else 0
+
+        for i in range(count):
+            value = int(samples[i] * (start + step * (i + 1)))
+            samples[i] = SAMPLE_MAX if value > SAMPLE_MAX else SAMPLE_MIN if value < SAMPLE_MIN else value
+
+        return samples.tobytes()
+
+    def rms(self, frame):
+        samples = array('h', frame)
+        return int(math.sqrt(sum(s * s for s in samples) / len(samples))) if samples else 0
+
+
+class AudioopGainStage(GainStage):
+    """
+        Uses audioop, which is fast but can't ramp, so gain changes are applied right away.
+    """
+
+    def _apply(self, frame, start, target):
+        return audioop.mul(frame, 2, target)
+
+    def rms(self, frame):
+        return audioop.rms(frame, 2)
+
+
+class NumpyGainStage(GainStage):
+    """
+        Uses numpy array operations on the whole frame.  The working buffers are allocated once and
+        reused for every frame of the same size, so the only allocation per frame is the returned bytes.
+    """
+
+    def __init__(self, gain=1.0, *, max_gain=2.0):
+        super().__init__(gain, max_gain=max_gain)
+        self._size = 0
+        self._work = None
+        self._out = None
+        self._ramp = None
+
+    def _buffers(self, count):
+        if count != self._size:
+            self._size = count
+            self._work = np.empty(count, dtype=np.float32)
+            self._out = np.empty(count, dtype='<i2')
+            self._ramp = np.linspace(1.0 / count, 1.0, count, dtype=np.float32)
+
+        return self._work, self._out, self._ramp
+
+    def _apply(self, frame, start, target):
+        samples = np.frombuffer(frame, dtype='<i2')
+        work, out, ramp = self._buffers(len(samples))
+
+        if start == target:
+            np.multiply(samples, target, out=work)
+        else:
+            # work = samples * (start + (target - start) * ramp)
+            np.multiply(ramp, target - start, out=work)
+            work += start
+            work *= samples
+
+        np.clip(work, SAMPLE_MIN, SAMPLE_MAX, out=work)
+        np.copyto(out, work, casting='unsafe')
+        return out.tobytes()
+
+    def rms(self, frame):
+        samples = np.frombuffer(frame, dtype='<i2')
+        return int(math.sqrt(np.dot(samples, samples.astype(np.float64)) / len(samples))) if len(samples) else 0
+
+
+def create_gain_stage(gain=1.0, *, max_gain=2.0):
+    """
+        Returns the fastest gain stage available: numpy, then audioop, then pure python.
+    """
+    if np is not None:
+        return NumpyGainStage(gain, max_gain=max_gain)
+
+    if audioop is not None:
+        return AudioopGainStage(gain, max_gain=max_gain)
+
+    return GainStage(gain, max_gain=max_gain)
+
+
+class Fade:
+    """
+        Fades a stream in or out over `frames` frames, using a gain stage to ramp smoothly within each frame.
+    """
+
+    def __init__(self, frames, *, fade_in):
+        self.frames = max(1, frames)
+        self.fade_in = fade_in
+        self.position = 0
+        self.gain_stage = create_gain_stage(0.0 if fade_in else 1.0, max_gain=1.0)
+
+    @property
+    def done(self):
+        return self.position >= self.frames
+
+    def process(self, frame):
+        self.position = min(self.position + 1, self.frames)
+        level = self.position / self.frames
+        self.gain_stage.gain = level if self.fade_in else 1.0 - level
+        return self.gain_stage.process(frame)
+
+
+class Mixer:
+    """
+        Adds two s16le pcm frames together, clipping instead of wrapping around.  The second frame can be
+        shorter than the first, in which case only that part is mixed.
+
+        This is the slow pure python version, use `create_mixer` to get the fastest one available.
+    """
+
+    def mix(self, frame, other):
+        samples = array('h', frame)
+        other = array('h', other[:len(frame)])
+
+        for i in range(len(other)):
+            value = samples[i] + other[i]
+            samples[i] = SAMPLE_MAX if value > SAMPLE_MAX else SAMPLE_MIN if value < SAMPLE_MIN else value
+
+        return samples.tobytes()
+
+
+class AudioopMixer(Mixer):
+    def mix(self, frame, other):
+        if len(other) < len(frame):
+            other += bytes(len(frame) - len(other))
+
+        return audioop.add(frame, other[:len(frame)], 2)
+
+
+class NumpyMixer(Mixer):
+    """
+        Mixes in a reused int32 buffer, so like NumpyGainStage the only allocation per frame is the result.
+    """
+
+    def __init__(self):
+        self._size = 0
+        self._work = None
+        self._out = None
+
+    def _buffers(self, count):
+        if count != self._size:
+            self._size = count
+            self._work = np.empty(count, dtype=np.int32)
+            self._out = np.empty(count, dtype='<i2')
+
+        return self._work, self._out
+
+    def mix(self, frame, other):
+        samples = np.frombuffer(frame, dtype='<i2')
+        work, out = self._buffers(len(samples))
+
+        other = np.frombuffer(other, dtype='<i2', count=min(len(other), len(frame)) // 2)
+        count = len(other)
+
+        np.copyto(work, samples)
+        work[:count] += other
+
+        np.clip(work, SAMPLE_MIN, SAMPLE_MAX, out=work)
+        np.copyto(out, work, casting='unsafe')
+        return out.tobytes()
+
+
+def create_mixer():
+    """
+        Returns the fastest mixer available: numpy, then audioop, then pure python.
+    """
+    if np is not None:
+        return NumpyMixer()
+
+    if audioop is not None:
+        return AudioopMixer()
+
+    return Mixer()
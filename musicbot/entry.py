@@ -1,9 +1,12 @@
 import asyncio
 import json
 import os
+import time
 import traceback
 
-from .exceptions import ExtractionError
+from .infocache import trim_info
+from .downloader import url_expiry, URL_EXPIRY_MARGIN
+from .exceptions import ExtractionError, ExtractionTimeout
 from .utils import get_header, md5sum
 
 
@@ -11,6 +14,7 @@ class BasePlaylistEntry:
     def __init__(self):
         self.filename = None
         self._is_downloading = False
+        self._download_task = None
         self._waiting_futures = []
 
     @property
@@ -20,6 +24,10 @@ class BasePlaylistEntry:
 
         return bool(self.filename)
 
+    @property
+    def is_downloading(self):
+        return self._is_downloading
+
     @classmethod
     def from_json(cls, playlist, jsonstring):
         raise NotImplementedError
@@ -27,13 +35,15 @@ class BasePlaylistEntry:
     def to_json(self):
         raise NotImplementedError
 
-    async def _download(self):
+    async def _download(self, pool='download'):
         raise NotImplementedError
 
-    def get_ready_future(self):
+    def get_ready_future(self, pool='download'):
         """
         Returns a future that will fire when the song is ready to be played. The future will either fire with the result (being the entry) or an exception
         as to why the song download failed.
+
+        `pool` is the downloader pool to use if the song has to be downloaded, "download" or "prefetch".
         """
         future = asyncio.Future()
         if self.is_downloaded:
@@ -42,11 +52,21 @@ class BasePlaylistEntry:
 
         else:
             # If we request a ready future, let's ensure that it'll actually resolve at one point.
-            asyncio.ensure_future(self._download())
+            if not self._download_task or self._download_task.done():
+                self._download_task = asyncio.ensure_future(self._download(pool))
+
             self._waiting_futures.append(future)
 
         return future
 
+    def cancel_download(self):
+        """
+            Stops downloading the song, for when it left the queue and nobody is going to play it.  Anything
+            waiting for it to be ready is cancelled.
+        """
+        if self._download_task and not self._download_task.done():
+            self._download_task.cancel()
+
     def _for_each_future(self, cb):
         """
             Calls `cb` for each future that is not cancelled. Absorbs and logs any errors that may have occurred.
@@ -72,7 +92,10 @@ class BasePlaylistEntry:
 
 
 class URLPlaylistEntry(BasePlaylistEntry):
-    def __init__(self, playlist, url, title, duration=0, expected_filename=None, **meta):
+    # Rough bitrate used to guess the download size of a song when ytdl doesn't know it (128 kbit/s)
+    ESTIMATED_BYTES_PER_SECOND = 16000
+
+    def __init__(self, playlist, url, title, duration=0, expected_filename=None, filesize=0, **meta):
         super().__init__()
 
         self.playlist = playlist
@@ -80,54 +103,153 @@ class URLPlaylistEntry(BasePlaylistEntry):
         self.title = title
         self.duration = duration
         self.expected_filename = expected_filename
+        self.filesize = filesize
         self.meta = meta
+        self._stream_url = None
+        self._stream_expires = 0
+
+        self._resolved_info = None
+        self._resolved_expires = 0
 
         self.download_folder = self.playlist.downloader.download_folder
 
     @classmethod
     def from_json(cls, playlist, jsonstring):
-        data = json.loads(jsonstring)
-        print(data)
-        # TODO: version check
-        url = data['url']
-        title = data['title']
-        duration = data['duration']
-        downloaded = data['downloaded']
-        filename = data['filename'] if downloaded else None
+        return cls.deserialize(playlist, json.loads(jsonstring))
+
+    @classmethod
+    def deserialize(cls, playlist, data):
+        """
+            Rebuilds an entry from what `serialize` returned, without looking anything up again.  Returns None if
+            the data is from a version we don't understand.
+        """
+        if data.get('version', None) != 1 or data.get('type', None) != cls.__name__:
+            return None
+
         meta = {}
+        channel = None
 
-        # TODO: Better [name] fallbacks
         if 'channel' in data['meta']:
-            ch = playlist.bot.get_channel(data['meta']['channel']['id'])
-            meta['channel'] = ch or data['meta']['channel']['name']
+            channel = playlist.bot.get_channel(data['meta']['channel']['id'])
+
+            # on_player_play needs the real thing, a name isn't going to cut it
+            if channel:
+                meta['channel'] = channel
+
+        if 'author' in data['meta'] and channel and channel.server:
+            author = channel.server.get_member(data['meta']['author']['id'])
 
-        if 'author' in data['meta']:
-            meta['author'] = meta['channel'].server.get_member(data['meta']['author']['id'])
+            if author:
+                meta['author'] = author
 
-        return cls(playlist, url, title, duration, filename, **meta)
+        entry = cls(
+            playlist,
+            data['url'],
+            data['title'],
+            data['duration'],
+            data.get('expected_filename', None),
+            data.get('filesize', 0),
+            **meta
+        )
+
+        filename = data.get('filename', None)
+
+        if filename and os.path.isfile(filename):
+            entry.filename = filename
+
+        return entry
+
+    @property
+    def estimated_size(self):
+        return self.filesize or self.duration * self.ESTIMATED_BYTES_PER_SECOND
+
+    @property
+    def extractor(self):
+        # self.expected_filename: audio_cache\youtube-9R8aSKwTEMg-NOMA_-_Brain_Power.m4a
+        return os.path.basename(self.expected_filename).split('-')[0] if self.expected_filename else None
 
     def to_json(self):
-        data = {
+        return json.dumps(self.serialize(), separators=(',', ':'))
+
+    def serialize(self):
+        return {
             'version': 1,
             'type': self.__class__.__name__,
             'url': self.url,
             'title': self.title,
             'duration': self.duration,
-            'downloaded': self.is_downloaded,
-            'filename': self.filename,
+            'expected_filename': self.expected_filename,
+            'filesize': self.filesize,
+            'filename': self.filename if self.is_downloaded else None,
             'meta': {
                 i: {
                     'type': self.meta[i].__class__.__name__,
                     'id': self.meta[i].id,
                     'name': self.meta[i].name
-                    } for i in self.meta
-                }
-            # Actually I think I can just getattr instead, getattr(discord, type)
+                } for i in self.meta if hasattr(self.meta[i], 'id')
+            }
         }
-        return json.dumps(data, indent=2)
+
+    def set_resolved_info(self, info, resolved_at=None):
+        """
+            Keeps what ytdl resolved the song to when it was looked up (chosen format, direct media url), so it
+            can be downloaded or streamed without extracting it again while the url is still good.
+        """
+        # Only processed infos have a format picked, anything else still needs a full extraction
+        if not info or not info.get('url', None) or 'format_id' not in info:
+            return
+
+        self._resolved_info = trim_info(info)
+        self._resolved_expires = url_expiry(info, resolved_at)
+
+    @property
+    def resolved_info(self):
+        """
+            The info the song was resolved to, or None if there isn't one or its url expired.
+        """
+        if self._resolved_info and time.time() > self._resolved_expires - URL_EXPIRY_MARGIN:
+            self._resolved_info = None
+
+        return self._resolved_info
+
+    @property
+    def stream_url(self):
+        """
+            The direct media url from resolve_stream_url, or None if there isn't one or it expired.
+        """
+        if self._stream_url and time.time() > self._stream_expires - URL_EXPIRY_MARGIN:
+            self._stream_url = None
+
+        return self._stream_url
+
+    async def resolve_stream_url(self):
+        """
+            Looks up the direct media url of the song, so it can be streamed by ffmpeg without downloading it first.
+        """
+        if self.stream_url:
+            return self.stream_url
+
+        info = self.resolved_info
+        expires = self._resolved_expires
+
+        if not info:
+            try:
+                info = await self.playlist.downloader.extract_info(self.playlist.loop, self.url, download=False)
+            except Exception as e:
+                raise ExtractionError(e)
+
+            if info:
+                expires = url_expiry(info)
+
+        if not info or not info.get('url', None):
+            raise ExtractionError("No se pudo obtener la url de reproducción de %s" % self.url)
+
+        self._stream_url = info['url']
+        self._stream_expires = expires
+        return self._stream_url
 
     # noinspection PyTypeChecker
-    async def _download(self):
+    async def _download(self, pool='download'):
         if self._is_downloading:
             return
 
@@ -137,67 +259,63 @@ class URLPlaylistEntry(BasePlaylistEntry):
             if not os.path.exists(self.download_folder):
                 os.makedirs(self.download_folder)
 
-            # self.expected_filename: audio_cache\youtube-9R8aSKwTEMg-NOMA_-_Brain_Power.m4a
-            extractor = os.path.basename(self.expected_filename).split('-')[0]
+            audio_cache = self.playlist.downloader.audio_cache
+            await audio_cache.wait_ready()
 
             # the generic extractor requires special handling
-            if extractor == 'generic':
+            if self.extractor == 'generic':
                 # print("Handling generic")
-                flistdir = [f.rsplit('-', 1)[0] for f in os.listdir(self.download_folder)]
-                expected_fname_noex, fname_ex = os.path.basename(self.expected_filename).rsplit('.', 1)
+                record = audio_cache.lookup_generic(self.expected_filename)
 
-                if expected_fname_noex in flistdir:
+                if record:
                     try:
                         rsize = int(await get_header(self.playlist.bot.aiosession, self.url, 'CONTENT-LENGTH'))
                     except:
                         rsize = 0
 
-                    lfile = os.path.join(
-                        self.download_folder,
-                        os.listdir(self.download_folder)[flistdir.index(expected_fname_noex)]
-                    )
+                    lfile = audio_cache.path_for(record)
 
                     # print("Resolved %s to %s" % (self.expected_filename, lfile))
-                    lsize = os.path.getsize(lfile)
+                    lsize = record['size']
                     # print("Remote size: %s Local size: %s" % (rsize, lsize))
 
                     if lsize != rsize:
-                        await self._really_download(hash=True)
+                        await self._really_download(hash=True, pool=pool)
                     else:
                         # print("[Download] Cached:", self.url)
                         self.filename = lfile
 
                 else:
                     # print("File not found in cache (%s)" % expected_fname_noex)
-                    await self._really_download(hash=True)
+                    await self._really_download(hash=True, pool=pool)
 
             else:
-                ldir = os.listdir(self.download_folder)
-                flistdir = [f.rsplit('.', 1)[0] for f in ldir]
+                record = audio_cache.lookup(self.expected_filename)
                 expected_fname_base = os.path.basename(self.expected_filename)
-                expected_fname_noex = expected_fname_base.rsplit('.', 1)[0]
-
-                # idk wtf this is but its probably legacy code
-                # or i have youtube to blame for changing shit again
 
-                if expected_fname_base in ldir:
+                if record and record['file'] == expected_fname_base:
                     self.filename = os.path.join(self.download_folder, expected_fname_base)
                     print("[Descarga] En caché:", self.url)
 
-                elif expected_fname_noex in flistdir:
+                elif record:
                     print("[Download] En caché (extención diferente):", self.url)
-                    self.filename = os.path.join(self.download_folder, ldir[flistdir.index(expected_fname_noex)])
+                    self.filename = audio_cache.path_for(record)
                     print("Esperado %s, obtenido %s" % (
                         self.expected_filename.rsplit('.', 1)[-1],
                         self.filename.rsplit('.', 1)[-1]
                     ))
 
                 else:
-                    await self._really_download()
+                    await self._really_download(pool=pool)
 
             # Trigger ready callbacks.
             self._for_each_future(lambda future: future.set_result(self))
 
+        except asyncio.CancelledError:
+            print("[Descarga] Cancelada:", self.url)
+            self._for_each_future(lambda future: future.cancel())
+            raise
+
         except Exception as e:
             traceback.print_exc()
             self._for_each_future(lambda future: future.set_exception(e))
@@ -206,13 +324,45 @@ class URLPlaylistEntry(BasePlaylistEntry):
             self._is_downloading = False
 
     # noinspection PyShadowingBuiltins
-    async def _really_download(self, *, hash=False):
+    async def _really_download(self, *, hash=False, pool='download'):
+        downloader = self.playlist.downloader
+
+        # Entries for the same song in other queues share the download instead of writing the same file at once
+        self.filename = await downloader.coalesce(
+            self.playlist.loop,
+            ('file', downloader.normalize_url(self.url), hash),
+            lambda: self._fetch_file(hash=hash, pool=pool)
+        )
+
+    # noinspection PyShadowingBuiltins
+    async def _fetch_file(self, *, hash=False, pool='download'):
         print("[Descarga] Empezada:", self.url)
 
-        try:
-            result = await self.playlist.downloader.extract_info(self.playlist.loop, self.url, download=True)
-        except Exception as e:
-            raise ExtractionError(e)
+        downloader = self.playlist.downloader
+        info = self.resolved_info
+        result = None
+
+        if info:
+            # Not needed after this either way
+            self._resolved_info = None
+
+            try:
+                result = await downloader.download_resolved(
+                    self.playlist.loop, info, pool=pool, extractor=self.extractor)
+            except (ExtractionTimeout, asyncio.CancelledError):
+                # Extracting it again would just make whoever is waiting for it wait twice as long
+                raise
+            except Exception as e:
+                print("[Descarga] Error con la url resuelta de %s, extrayendo de nuevo: %s" % (self.url, e))
+
+        if result is None:
+            try:
+                result = await downloader.extract_info(
+                    self.playlist.loop, self.url, download=True, pool=pool, extractor=self.extractor)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                raise ExtractionError(e)
 
         print("[Descarga] Completada:", self.url)
 
@@ -220,18 +370,22 @@ class URLPlaylistEntry(BasePlaylistEntry):
             raise ExtractionError("ytdl broke and hell if I know why")
             # What the fuck do I do now?
 
-        self.filename = unhashed_fname = self.playlist.downloader.ytdl.prepare_filename(result)
+        filename = unhashed_fname = self.playlist.downloader.ytdl.prepare_filename(result)
 
         if hash:
             # insert the 8 last characters of the file hash to the file name to ensure uniqueness
-            self.filename = md5sum(unhashed_fname, 8).join('-.').join(unhashed_fname.rsplit('.', 1))
+            filename = md5sum(unhashed_fname, 8).join('-.').join(unhashed_fname.rsplit('.', 1))
 
-            if os.path.isfile(self.filename):
+            if os.path.isfile(filename):
                 # Oh bother it was actually there.
                 os.unlink(unhashed_fname)
             else:
                 # Move the temporary file to it's final location.
-                os.rename(unhashed_fname, self.filename)
+                os.rename(unhashed_fname, filename)
+
+        self.playlist.downloader.audio_cache.add(filename)
+        self.playlist.downloader.audio_cache.queue_analysis(filename)
+        return filename
 
 
 
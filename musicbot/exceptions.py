@@ -23,6 +23,14 @@ class CommandError(MusicbotException):
 class ExtractionError(MusicbotException):
     pass
 
+# youtube-dl took too long to look up or download a song
+class ExtractionTimeout(ExtractionError):
+    pass
+
+# A download was stopped because nobody wants the song anymore
+class DownloadCancelled(ExtractionError):
+    pass
+
 # The no processing entry type failed and an entry was a playlist/vice versa
 class WrongEntryTypeError(ExtractionError):
     def __init__(self, message, is_playlist, use_url):
@@ -0,0 +1,138 @@
+import time
+import pickle
+import weakref
+import threading
+import youtube_dl
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .infocache import trim_info
+
+# The YoutubeDL objects of a worker process, made on its first job
+_ytdls = {}
+
+
+def _get_ytdl(name, params):
+    ytdl = _ytdls.get(name, None)
+
+    if ytdl is None:
+        youtube_dl.utils.bug_reports_message = lambda: ''
+        ytdl = _ytdls[name] = youtube_dl.YoutubeDL(params)
+
+    return ytdl
+
+
+def _picklable(e):
+    # Some extractor errors drag along things that can't cross back to the bot, like open responses
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError('%s: %s' % (e.__class__.__name__, e))
+
+
+def extract_info(name, params, args, kwargs):
+    """
+        Runs ytdl.extract_info in a worker process, see ExtractionProcessPool.  `name` and `params` pick the
+        YoutubeDL object to use.  Returns the info without the bulky fields nothing reads, so there's less to
+        send back.
+    """
+    try:
+        info = _get_ytdl(name, params).extract_info(*args, **kwargs)
+
+        if not info:
+            return info
+
+        if 'entries' in info and not isinstance(info['entries'], list):
+            info['entries'] = list(info['entries'])
+
+        info['_resolved_at'] = time.time()
+        return trim_info(info)
+
+    except Exception as e:
+        raise _picklable(e) from None
+
+
+def process_info(name, params, info):
+    """
+        Runs ytdl.process_info in a worker process, downloading an already resolved info.
+    """
+    try:
+        ytdl = _get_ytdl(name, params)
+        ytdl.process_info(info)
+        return info
+
+    except Exception as e:
+        raise _picklable(e) from None
+
+
+class ExtractionProcessPool(Executor):
+    """
+        A process pool that replaces its workers after every `max_jobs` jobs each, so whatever youtube-dl
+        leaks or caches doesn't build up forever.  A pool that broke because a worker died is replaced too.
+
+        The old workers finish what they were doing before they exit, unless they're stuck, see `kill`.
+    """
+
+    def __init__(self, max_workers, max_jobs=0):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+
+        self._executor = None
+        self._jobs = 0
+        self._lock = threading.Lock()
+
+        # Which pool each job went to, so a stuck job can be killed even after its pool was replaced
+        self._job_executors = weakref.WeakKeyDictionary()
+
+    def _replace(self):
+        old, self._executor = self._executor, ProcessPoolExecutor(max_workers=self.max_workers)
+        self._jobs = 0
+
+        if old:
+            old.shutdown(wait=False)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if not self._executor or (self.max_jobs and self._jobs >= self.max_jobs * self.max_workers):
+                self._replace()
+
+            self._jobs += 1
+
+            try:
+                future = self._executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                self._replace()
+                future = self._executor.submit(fn, *args, **kwargs)
+
+            self._job_executors[future] = self._executor
+            return future
+
+    def kill(self, future):
+        """
+            Kills the workers of the pool that's running the job of `future`, for when it's stuck.  Anything else
+            that pool was running fails with BrokenProcessPool.  New jobs go to a fresh pool.
+        """
+        with self._lock:
+            executor = self._job_executors.pop(future, None)
+            if not executor:
+                return
+
+            if executor is self._executor:
+                self._executor = None
+
+        # Which worker has which job isn't something ProcessPoolExecutor tells, so all of them go
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            try:
+                process.terminate()
+            except Exception:
+                pass
+
+        executor.shutdown(wait=False)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+import traceback
+
+from collections import OrderedDict
+
+# Keys that ytdl puts in info dicts that nothing in the bot ever reads, but which make up most of their size
+_BULKY_KEYS = (
+    'formats', 'thumbnails', 'subtitles', 'automatic_captions', 'requested_subtitles',
+    'annotations', 'description', 'tags', 'categories'
+)
+
+
+def trim_info(info):
+    """
+        Returns a copy of `info` without the bulky fields we don't use, recursing into playlist entries.
+    """
+    trimmed = {k: v for k, v in info.items() if k not in _BULKY_KEYS}
+
+    if isinstance(trimmed.get('entries', None), list):
+        trimmed['entries'] = [trim_info(e) if isinstance(e, dict) else e for e in trimmed['entries']]
+
+    return trimmed
+
+
+class InfoCache:
+    """
+        A persistent, size bounded LRU cache for ytdl info dicts, keyed by url and the `process` flag.
+        Items expire after `ttl` seconds, since things like direct media urls don't live forever.
+    """
+
+    def __init__(self, cache_file, *, max_entries=2000, ttl=3600):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self.dirty = False
+
+        # Saves can come from an executor and the event loop at once, see save
+        self._save_lock = threading.Lock()
+        self._snapshots = 0
+        self._saved_snapshot = 0
+
+        if self.enabled:
+            self.load()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    @staticmethod
+    def _key(url, process):
+        return '%d|%s' % (bool(process), url)
+
+    def get(self, url, process=True):
+        """
+            Returns a copy of the cached info for `url` or None if there isn't a fresh one.
+        """
+        key = self._key(url, process)
+        item = self._entries.get(key, None)
+
+        if item is None:
+            return None
+
+        stored_at, data = item
+
+        if time.time() - stored_at > self.ttl:
+            del self._entries[key]
+            self.dirty = True
+            return None
+
+        self._entries.move_to_end(key)
+
+        # Callers are free to mess with what they get back, so hand out a fresh copy every time
+        return json.loads(data)
+
+    def put(self, url, process, info):
+        if not self.enabled or not info:
+            return
+
+        try:
+            data = json.dumps(trim_info(info), separators=(',', ':'))
+        except (TypeError, ValueError):
+            # Not everything ytdl returns is json friendly, those we just don't cache
+            return
+
+        key = self._key(url, process)
+        self._entries[key] = (time.time(), data)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        self.dirty = True
+
+    def discard(self, url, process=True):
+        if self._entries.pop(self._key(url, process), None) is not None:
+            self.dirty = True
+
+    def clear(self):
+        self._entries.clear()
+        self.dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        try:
+            with open(self.cache_file, encoding='utf8') as f:
+                items = json.load(f)
+
+        except FileNotFoundError:
+            return
+
+        except Exception:
+            traceback.print_exc()
+            print("[InfoCache] No se pudo cargar %s, empezando con un caché vacío" % self.cache_file)
+            return
+
+        now = time.time()
+
+        # Items are stored from least to most recently used
+        for key, stored_at, data in items[-self.max_entries:]:
+            if now - stored_at <= self.ttl:
+                self._entries[key] = (stored_at, data)
+
+    def snapshot(self):
+        """
+            Returns a cheap copy of the cache contents that can be written to disk from another thread, numbered
+            so save can tell which one is newer.
+        """
+        self.dirty = False
+        self._snapshots += 1
+        return self._snapshots, [(key, stored_at, data) for key, (stored_at, data) in self._entries.items()]
+
+    def save(self, snapshot=None):
+        """
+            Writes `snapshot` to disk, or the current contents if not given.  Saves are serialized, and a snapshot
+            older than the last one written is skipped so it can't overwrite newer contents.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        number, items = snapshot
+
+        with self._save_lock:
+            if number <= self._saved_snapshot:
+                return
+
+            folder = os.path.dirname(self.cache_file)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+
+            tmpfile = self.cache_file + '.tmp'
+            with open(tmpfile, 'w', encoding='utf8') as f:
+                json.dump(items, f, separators=(',', ':'))
+
+            os.replace(tmpfile, self.cache_file)
+            self._saved_snapshot = number
@@ -0,0 +1,47 @@
+import json
+import asyncio
+import subprocess
+
+# Don't boost quiet songs more than this, or the noise floor comes up with them
+MAX_BOOST_DB = 6.0
+MAX_CUT_DB = -24.0
+
+
+async def measure_loudness(filename, *, loop=None):
+    """
+        Runs the file through ffmpeg's loudnorm filter in analysis mode and returns its integrated
+        loudness in LUFS, or None if it couldn't be measured (silence, broken file, old ffmpeg, etc).
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-i', filename,
+        '-vn', '-af', 'loudnorm=print_format=json', '-f', 'null', '-',
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, loop=loop
+    )
+
+    _, stderr = await process.communicate()
+
+    if process.returncode:
+        return None
+
+    # The stats are printed as a json object at the very end of the output
+    output = stderr.decode('utf8', 'replace')
+    start, end = output.rfind('{'), output.rfind('}')
+
+    if start == -1 or end < start:
+        return None
+
+    try:
+        loudness = float(json.loads(output[start:end + 1])['input_i'])
+    except (ValueError, KeyError):
+        return None
+
+    # -inf for silence
+    return loudness if loudness > -70 else None
+
+
+def gain_for(loudness, target):
+    """
+        Returns the linear gain that brings a song of `loudness` LUFS to `target` LUFS.
+    """
+    gain_db = max(MAX_CUT_DB, min(target - loudness, MAX_BOOST_DB))
+    return 10 ** (gain_db / 20)
@@ -0,0 +1,207 @@
+import os
+import time
+import struct
+import threading
+
+from discord.voice_client import StreamPlayer
+
+from .constants import PCM_BYTES_PER_SECOND
+
+'''
+    Opus frame cache files are a small header followed by every encoded frame of the song, each one
+    prefixed with its length:
+
+        b'MBOP' | version (u8) | gain (f64) | (length (u16) | opus packet) * n
+
+    The gain is the volume the frames were encoded at, since there's no changing it after the fact.
+'''
+
+MAGIC = b'MBOP'
+VERSION = 1
+HEADER = struct.Struct('<4sBd')
+LENGTH = struct.Struct('<H')
+
+# Every frame is 20ms, which is this many bytes of the pcm it was encoded from
+FRAME_PCM_BYTES = 3840
+
+
+class OpusFrameWriter:
+    """
+        Writes opus frames to a temporary file, which only replaces the real one once `finish` is called.
+    """
+
+    def __init__(self, path, gain):
+        self.path = path
+        self.gain = gain
+        self.closed = False
+
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        # Unique per writer in case two servers happen to be playing the same song
+        self._tmpfile = '%s.%s.tmp' % (path, id(self))
+        self._file = open(self._tmpfile, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, gain))
+        self._lock = threading.Lock()
+
+    def write(self, packet):
+        with self._lock:
+            if not self.closed:
+                self._file.write(LENGTH.pack(len(packet)))
+                self._file.write(packet)
+
+    def finish(self):
+        with self._lock:
+            if self.closed:
+                return
+
+            self.closed = True
+            self._file.close()
+            os.replace(self._tmpfile, self.path)
+
+    def abort(self):
+        with self._lock:
+            if self.closed:
+                return
+
+            self.closed = True
+            self._file.close()
+
+            try:
+                os.unlink(self._tmpfile)
+            except OSError:
+                pass
+
+
+class OpusFrameReader:
+    """
+        Reads back the frames of an opus frame cache file.  Stands in for PatchedBuff on an OpusFramePlayer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.frame_count = 0
+        self.bytes_read = 0
+        self.eof = False
+        self._file = open(path, 'rb')
+
+        try:
+            magic, version, self.gain = HEADER.unpack(self._file.read(HEADER.size))
+        except struct.error:
+            magic, version = None, None
+
+        if magic != MAGIC or version != VERSION:
+            self._file.close()
+            raise ValueError('%s is not an opus frame cache file' % path)
+
+        # Volume changes are handled by MusicPlayer switching back to ffmpeg
+        self.volume = None
+
+    @classmethod
+    def open(cls, path):
+        """
+            Returns a reader for `path`, or None if there's no usable cache file there.
+        """
+        try:
+            return cls(path)
+        except (OSError, ValueError):
+            return None
+
+    @property
+    def position(self):
+        return self.bytes_read / PCM_BYTES_PER_SECOND
+
+    def matches(self, gain):
+        return abs(self.gain - gain) < 1e-4
+
+    def read(self, frame_size=None):
+        """
+            Returns the next opus packet, or an empty bytes object at the end of the file.
+        """
+        header = self._file.read(LENGTH.size)
+
+        if len(header) != LENGTH.size:
+            self.eof = True
+            return b''
+
+        length, = LENGTH.unpack(header)
+        packet = self._file.read(length)
+
+        if len(packet) != length:
+            self.eof = True
+            return b''
+
+        self.frame_count += 1
+        self.bytes_read += FRAME_PCM_BYTES
+        return packet
+
+    def close(self):
+        self._file.close()
+
+
+class OpusFramePlayer(StreamPlayer):
+    """
+        Plays pre-encoded opus frames straight to the voice connection, without ffmpeg or the encoder.
+    """
+
+    def __init__(self, reader, voice_client, *, after=None):
+        super().__init__(reader, voice_client.encoder, voice_client._connected, self._send, after)
+        self.voice_client = voice_client
+
+    def _send(self, packet):
+        self.voice_client.play_audio(packet, encode=False)
+
+    def _do_run(self):
+        # Same as StreamPlayer's, except packets vary in size so only an empty read means we're done
+        self.loops = 0
+        self._start = time.time()
+
+        try:
+            while not self._end.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+
+                if not self._connected.is_set():
+                    self.stop()
+                    break
+
+                self.loops += 1
+                packet = self.buff.read()
+
+                if not packet:
+                    self.stop()
+                    break
+
+                self.player(packet)
+                next_time = self._start + self.delay * self.loops
+                delay = max(0, self.delay + (next_time - time.time()))
+                time.sleep(delay)
+
+        finally:
+            self.buff.close()
+
+
+class OpusRecorder:
+    """
+        Replaces a player's send function, encoding the frames itself so they can be written to the cache
+        before being sent.  Gives up on the recording if the volume changes halfway through.
+    """
+
+    def __init__(self, voice_client, buff, writer):
+        self.voice_client = voice_client
+        self.buff = buff
+        self.writer = writer
+
+    def __call__(self, data):
+        if self.writer.closed:
+            return self.voice_client.play_audio(data)
+
+        if self.buff.gain_stage.gain != self.writer.gain:
+            self.writer.abort()
+            return self.voice_client.play_audio(data)
+
+        encoder = self.voice_client.encoder
+        packet = encoder.encode(data, encoder.samples_per_frame)
+        self.writer.write(packet)
+        self.voice_client.play_audio(packet, encode=False)
@@ -25,6 +25,7 @@ class PermissionsDefaults:
 class Permissions:
     def __init__(self, config_file, grant_all=None):
         self.config_file = config_file
+        self.grant_all = grant_all
         self.config = configparser.ConfigParser(interpolation=None)
 
         if not self.config.read(config_file, encoding='utf-8'):
@@ -38,20 +39,49 @@ class Permissions:
                 traceback.print_exc()
                 raise RuntimeError("No se puede copiar config/example_permissions.ini en %s: %s" % (config_file, e))
 
-        self.default_group = PermissionGroup('Default', self.config['Default'])
-        self.groups = set()
+        self._user_index = {}
+        self._role_index = {}
+        self._resolved = {}
 
-        for section in self.config.sections():
-            self.groups.add(PermissionGroup(section, self.config[section]))
+        self._load_groups()
+
+    def _load_groups(self):
+        self.default_group = PermissionGroup('Default', self.config['Default'])
 
         # Create a fake section to fallback onto the permissive default values to grant to the owner
         # noinspection PyTypeChecker
         owner_group = PermissionGroup("Owner (auto)", configparser.SectionProxy(self.config, None))
-        if hasattr(grant_all, '__iter__'):
-            owner_group.user_list = set(grant_all)
+        if hasattr(self.grant_all, '__iter__'):
+            owner_group.user_list = set(self.grant_all)
+
+        # Earlier groups win when a user matches more than one, so the owner goes first and the rest
+        # keep the order they have in the file
+        self.groups = [owner_group]
+
+        for section in self.config.sections():
+            self.groups.append(PermissionGroup(section, self.config[section]))
+
+        self.invalidate()
+
+    def invalidate(self, user_id=None):
+        """
+        Forgets what group a user was resolved to, or rebuilds the lookup indexes if no user is given.
+        Changing the users of a group through add_user and remove_user takes care of it.
+        """
+        if user_id is not None:
+            self._resolved.pop(user_id, None)
+            return
+
+        self._user_index.clear()
+        self._role_index.clear()
+        self._resolved.clear()
 
-        self.groups.add(owner_group)
+        for priority, group in enumerate(self.groups):
+            for uid in group.user_list:
+                self._user_index.setdefault(uid, group)
 
+            for role_id in group.granted_to_roles:
+                self._role_index.setdefault(role_id, (priority, group))
 
     def save(self):
         with open(self.config_file, 'w') as f:
@@ -63,27 +93,46 @@ class Permissions:
         :param user: A discord User or Member object
         """
 
-        for group in self.groups:
-            if user.id in group.user_list:
-                return group
+        group = self._user_index.get(user.id, None)
+        if group:
+            return group
 
         # The only way I could search for roles is if I add a `server=None` param and pass that too
         if type(user) == discord_User:
             return self.default_group
 
-        # We loop again so that we don't return a role based group before we find an assigned one
-        for group in self.groups:
-            for role in user.roles:
-                if role.id in group.granted_to_roles:
-                    return group
+        role_ids = frozenset(role.id for role in user.roles)
+        resolved = self._resolved.get(user.id, None)
+
+        # Only reuse the last answer if their roles haven't changed since
+        if resolved and resolved[0] == role_ids:
+            return resolved[1]
 
-        return self.default_group
+        # Role based groups only apply when the user isn't assigned to one directly, which was checked above
+        group = self.default_group
+        matches = [self._role_index[role_id] for role_id in role_ids if role_id in self._role_index]
+        if matches:
+            group = min(matches, key=lambda match: match[0])[1]
+
+        self._resolved[user.id] = (role_ids, group)
+        return group
 
     def create_group(self, name, **kwargs):
         self.config.read_dict({name:kwargs})
-        self.groups.add(PermissionGroup(name, self.config[name]))
+        self.groups.append(PermissionGroup(name, self.config[name]))
+        self.invalidate()
         # TODO: Test this
 
+    def add_user(self, group, uid):
+        # Groups without a UserList share the default empty set, so they get their own one instead
+        group.user_list = set(group.user_list) | {uid}
+        self.invalidate()
+
+    def remove_user(self, group, uid):
+        if uid in group.user_list:
+            group.user_list = set(group.user_list) - {uid}
+            self.invalidate()
+
 
 class PermissionGroup:
     def __init__(self, name, section_data):
@@ -143,15 +192,6 @@ class PermissionGroup:
             self.instaskip, PermissionsDefaults.InstaSkip
         )
 
-
-    def add_user(self, uid):
-        self.user_list.add(uid)
-
-    def remove_user(self, uid):
-        if uid in self.user_list:
-            self.user_list.pop(uid)
-
-
     def __repr__(self):
         return "<PermissionGroup: %s>" % self.name
 
@@ -1,14 +1,23 @@
 import os
 import asyncio
-import audioop
+import threading
 import traceback
 
 from enum import Enum
-from array import array
+from functools import partial
 from collections import deque
 from shutil import get_terminal_size
 
+from .dsp import Fade, create_gain_stage, create_mixer
+from .loudness import gain_for
+from .opuscache import OpusFramePlayer, OpusFrameReader, OpusFrameWriter, OpusRecorder
 from .lib.event_emitter import EventEmitter
+from .constants import PCM_BYTES_PER_SECOND
+
+# How many seconds before the end of a song (or the crossfade) the next one gets its player ready, see GaplessPlayback
+GAPLESS_LEAD_TIME = 5
+
+FRAMES_PER_SECOND = 50
 
 
 class PatchedBuff:
@@ -19,28 +28,84 @@ class PatchedBuff:
     def __init__(self, buff, *, draw=False):
         self.buff = buff
         self.frame_count = 0
-        self.volume = 1.0
+        self.bytes_read = 0
+        self.eof = False
+        self.gain_stage = create_gain_stage(1.0, max_gain=2)
+        self._volume = 1.0
+        self._normalization_gain = 1.0
+
+        # Set while crossfading, see crossfade_into
+        self.fade = None
+        self.mix_source = None
+        self._mixer = None
 
         self.draw = draw
-        self.use_audioop = True
         self.frame_skip = 2
         self.rmss = deque([2048], maxlen=90)
 
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        self._update_gain()
+
+    @property
+    def normalization_gain(self):
+        return self._normalization_gain
+
+    @normalization_gain.setter
+    def normalization_gain(self, value):
+        self._normalization_gain = value
+        self._update_gain()
+
+    def _update_gain(self):
+        # The gain stage ramps to the new gain over the next frame, unless nothing has played yet
+        self.gain_stage.gain = self._volume * self._normalization_gain
+
+        if not self.frame_count:
+            self.gain_stage.reset()
+
     def __del__(self):
         if self.draw:
             print(' ' * (get_terminal_size().columns-1), end='\r')
 
+    @property
+    def position(self):
+        """
+            How many seconds of audio have been read so far.
+        """
+        return self.bytes_read / PCM_BYTES_PER_SECOND
+
     def read(self, frame_size):
         self.frame_count += 1
 
         frame = self.buff.read(frame_size)
+        self.bytes_read += len(frame)
 
-        if self.volume != 1:
-            frame = self._frame_vol(frame, self.volume, maxv=2)
+        if len(frame) != frame_size:
+            # The player stops on a short read, so we know the song played to the end
+            self.eof = True
+            return self.gain_stage.process(frame)
+
+        frame = self.gain_stage.process(frame)
+
+        fade, mix_source = self.fade, self.mix_source
+
+        if fade:
+            frame = fade.process(frame)
+
+            if fade.done and fade.fade_in:
+                self.fade = None
+
+        if mix_source:
+            frame = self._mixer.mix(frame, mix_source.read(frame_size))
 
         if self.draw and not self.frame_count % self.frame_skip:
             # these should be processed for every frame, but "overhead"
-            rms = audioop.rms(frame, 2)
+            rms = self.gain_stage.rms(frame)
             self.rmss.append(rms)
 
             max_rms = sorted(self.rmss)[-1]
@@ -49,17 +114,21 @@ class PatchedBuff:
 
         return frame
 
-    def _frame_vol(self, frame, mult, *, maxv=2, use_audioop=True):
-        if use_audioop:
-            return audioop.mul(frame, 2, min(mult, maxv))
-        else:
-            # ffmpeg returns s16le pcm frames.
-            frame_array = array('h', frame)
+    def crossfade_into(self, other, frames):
+        """
+            Fades this stream out and `other` in over `frames` frames, mixing `other` into what we return.
+            `other` keeps fading in on its own if it outlives this one.
+        """
+        if not self._mixer:
+            self._mixer = create_mixer()
 
-            for i in range(len(frame_array)):
-                frame_array[i] = int(frame_array[i] * min(mult, min(1, maxv)))
+        other.fade = Fade(frames, fade_in=True)
+        self.fade = Fade(frames, fade_in=False)
+        self.mix_source = other
 
-            return frame_array.tobytes()
+    def cancel_crossfade(self):
+        self.mix_source = None
+        self.fade = None
 
     def _avg(self, i):
         return sum(i) / len(i)
@@ -86,6 +155,52 @@ class MusicPlayerState(Enum):
         return self.name
 
 
+class PreparedPlayer:
+    """
+        The player for the next song, created before the current one ends so its ffmpeg is already running
+        (and has filled its output pipe) when it's needed.  Gets started straight from the thread of the
+        player it replaces, or thrown away if something changed in the meantime.
+    """
+
+    def __init__(self, entry, player):
+        self.entry = entry
+        self.player = player
+        self.started = False
+        self.discarded = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.started or self.discarded:
+                return False
+
+            self.started = True
+            self.player.start()
+            return True
+
+    def discard(self):
+        """
+            Gets rid of the player, stopping it if it already got started.
+        """
+        with self._lock:
+            self.discarded = True
+            started = self.started
+
+        self.player.after = None
+
+        if self.player.opus_recorder:
+            self.player.opus_recorder.writer.abort()
+
+        try:
+            self.player.stop()
+        except OSError:
+            pass
+
+        if not started and isinstance(self.player, OpusFramePlayer):
+            # Never ran, so it never got to close its file
+            self.player.buff.close()
+
+
 class MusicPlayer(EventEmitter):
     def __init__(self, bot, voice_client, playlist):
         super().__init__()
@@ -99,10 +214,12 @@ class MusicPlayer(EventEmitter):
         self._play_lock = asyncio.Lock()
         self._current_player = None
         self._current_entry = None
+        self._prepared = None
+        self._prepare_handle = None
+        self._crossfade_handle = None
+        self._resume_at = None
         self.state = MusicPlayerState.STOPPED
 
-        self.loop.create_task(self.websocket_check())
-
     @property
     def volume(self):
         return self._volume
@@ -113,6 +230,16 @@ class MusicPlayer(EventEmitter):
         if self._current_player:
             self._current_player.buff.volume = value
 
+            if isinstance(self._current_player, OpusFramePlayer):
+                # Cached frames can't change volume, so decode the file again from where we are
+                self._restart_at(self.position)
+
+        if self._prepared:
+            if isinstance(self._prepared.player, OpusFramePlayer):
+                self._discard_prepared()
+            else:
+                self._prepared.player.buff.volume = value
+
     def on_entry_added(self, playlist, entry):
         if self.is_stopped:
             self.loop.call_later(2, self.play)
@@ -120,8 +247,33 @@ class MusicPlayer(EventEmitter):
     def skip(self):
         self._kill_current_player()
 
+    def resume_at(self, entry, position):
+        """
+            Starts `entry` at `position` seconds instead of the beginning when it comes up, for restoring a
+            saved queue.
+        """
+        self._resume_at = (entry, position)
+
+    def seek(self, position):
+        """
+            Jumps to `position` seconds into the current song.
+        """
+        if not self._current_player or not self._current_entry:
+            raise ValueError('Cannot seek a MusicPlayer in state %s' % self.state)
+
+        position = max(0.0, position)
+
+        if self._current_entry.duration:
+            # Seeking past the end just ends the song
+            position = min(position, self._current_entry.duration)
+
+        self._discard_prepared()
+        self._restart_at(position)
+        self._schedule_prepare()
+
     def stop(self):
         self.state = MusicPlayerState.STOPPED
+        self._discard_prepared()
         self._kill_current_player()
 
         self.emit('stop', player=self)
@@ -130,6 +282,7 @@ class MusicPlayer(EventEmitter):
         if self.is_paused and self._current_player:
             self._current_player.resume()
             self.state = MusicPlayerState.PLAYING
+            self._schedule_prepare()
             self.emit('resume', player=self, entry=self.current_entry)
             return
 
@@ -159,21 +312,42 @@ class MusicPlayer(EventEmitter):
         self.state = MusicPlayerState.DEAD
         self.playlist.clear()
         self._events.clear()
+        self._discard_prepared()
         self._kill_current_player()
 
-    def _playback_finished(self):
+    def _player_ended(self, player):
+        # Runs on the thread of the player that just ended, right after its last frame, so if the next song
+        # is ready it starts on the very next frame instead of after a trip through the event loop
+        prepared = self._prepared
+
+        try:
+            if prepared and player.buff.eof and self.playlist.peek() is prepared.entry:
+                prepared.start()
+
+        finally:
+            # Whatever went wrong above, the player has to hear that this song is over
+            self.loop.call_soon_threadsafe(self._playback_finished, player)
+
+    def _playback_finished(self, player):
+        if self._current_player not in (None, player):
+            # Something else already took over
+            return
+
         entry = self._current_entry
 
-        if self._current_player:
-            self._current_player.after = None
-            self._kill_current_player()
+        if player.opus_recorder and player.buff.eof:
+            player.opus_recorder.writer.finish()
+            self.playlist.downloader.audio_cache.add_opus(player.opus_recorder.writer.path)
+
+        player.after = None
+        self._kill_current_player()
 
         self._current_entry = None
 
         if not self.is_stopped and not self.is_dead:
             self.play(_continue=True)
 
-        if not self.bot.config.save_videos and entry:
+        if not self.bot.config.save_videos and entry and entry.filename:
             if any([entry.filename == e.filename for e in self.playlist.entries]):
                 print("[Config:SaveVideos] Skipping deletion, found song in queue")
 
@@ -185,6 +359,9 @@ class MusicPlayer(EventEmitter):
 
     def _kill_current_player(self):
         if self._current_player:
+            if self._current_player.opus_recorder:
+                self._current_player.opus_recorder.writer.abort()
+
             if self.is_paused:
                 self.resume()
 
@@ -193,6 +370,7 @@ class MusicPlayer(EventEmitter):
             except OSError:
                 pass
             self._current_player = None
+            self._cancel_prepare()
             return True
 
         return False
@@ -201,6 +379,7 @@ class MusicPlayer(EventEmitter):
         for x in range(30):
             try:
                 os.unlink(filename)
+                self.playlist.downloader.audio_cache.remove(filename)
                 break
 
             except PermissionError as e:
@@ -230,8 +409,17 @@ class MusicPlayer(EventEmitter):
 
         with await self._play_lock:
             if self.is_stopped or _continue:
+                prepared, self._prepared = self._prepared, None
+
+                if prepared and (prepared.started or self.playlist.peek() is prepared.entry):
+                    self._play_prepared(prepared)
+                    return
+
+                elif prepared:
+                    prepared.discard()
+
                 try:
-                    entry = await self.playlist.get_next_entry()
+                    entry = await self.playlist.get_next_entry(stream=self.bot.config.stream_mode)
 
                 except Exception as e:
                     print("Failed to get entry.")
@@ -248,23 +436,233 @@ class MusicPlayer(EventEmitter):
                 # In-case there was a player, kill it. RIP.
                 self._kill_current_player()
 
-                self._current_player = self._monkeypatch_player(self.voice_client.create_ffmpeg_player(
-                    entry.filename,
-                    before_options="-nostdin",
-                    options="-vn -b:a 128k",
-                    # Threadsafe call soon, b/c after will be called from the voice playback thread.
-                    after=lambda: self.loop.call_soon_threadsafe(self._playback_finished)
-                ))
-                self._current_player.setDaemon(True)
-                self._current_player.buff.volume = self.volume
+                start_at = 0
+                if self._resume_at and self._resume_at[0] is entry:
+                    start_at = self._resume_at[1]
+
+                self._resume_at = None
+                self._current_player = self._create_player(entry, start_at)
+
+                if entry.filename:
+                    self.playlist.downloader.audio_cache.touch(entry.filename)
 
                 # I need to add ytdl hooks
                 self.state = MusicPlayerState.PLAYING
                 self._current_entry = entry
 
                 self._current_player.start()
+                self._schedule_prepare()
                 self.emit('play', player=self, entry=entry)
 
+    def _play_prepared(self, prepared):
+        """
+            Makes the prepared player the current one, starting it if the old one didn't get to.
+        """
+        entry = prepared.entry
+        self.playlist.take(entry, stream=self.bot.config.stream_mode)
+
+        self._kill_current_player()
+        self._current_player = prepared.player
+
+        if entry.filename:
+            self.playlist.downloader.audio_cache.touch(entry.filename)
+
+        self.state = MusicPlayerState.PLAYING
+        self._current_entry = entry
+
+        prepared.start()
+        self._schedule_prepare()
+        self.emit('play', player=self, entry=entry)
+
+    def _schedule_prepare(self):
+        """
+            Arranges for the next song to be prepared a bit before the current one ends.
+        """
+        self._cancel_prepare()
+
+        entry = self._current_entry
+        if not (self.bot.config.gapless_playback or self.bot.config.crossfade) or not entry or not entry.duration:
+            return
+
+        delay = max(0, entry.duration - self.position - self._prepare_lead_time)
+        self._prepare_handle = self.loop.call_later(delay, self._prepare_due)
+
+    def _cancel_prepare(self):
+        if self._prepare_handle:
+            self._prepare_handle.cancel()
+            self._prepare_handle = None
+
+        if self._crossfade_handle:
+            self._crossfade_handle.cancel()
+            self._crossfade_handle = None
+
+    @property
+    def _prepare_lead_time(self):
+        return GAPLESS_LEAD_TIME + self.bot.config.crossfade
+
+    def _prepare_due(self):
+        self._prepare_handle = None
+
+        # Paused, resume() will schedule it again
+        if not self.is_playing or not self._current_entry:
+            return
+
+        if self._current_entry.duration - self.position > self._prepare_lead_time + 1:
+            # Playback fell behind somehow, a reconnect maybe
+            self._schedule_prepare()
+            return
+
+        asyncio.ensure_future(self._prepare_next(), loop=self.loop)
+
+    async def _prepare_next(self):
+        with await self._play_lock:
+            entry = self.playlist.peek()
+
+            if not self._prepared and entry and self.is_playing:
+                # Not worth waiting for, if it isn't ready by now it plays the normal way
+                if entry.is_downloaded or (self.bot.config.stream_mode and entry.stream_url):
+                    try:
+                        self._prepared = PreparedPlayer(entry, self._create_player(entry))
+                    except Exception:
+                        traceback.print_exc()
+
+            if self._prepared:
+                self._schedule_crossfade()
+
+    def _discard_prepared(self):
+        prepared, self._prepared = self._prepared, None
+
+        if prepared:
+            if self._current_player and isinstance(self._current_player.buff, PatchedBuff):
+                self._current_player.buff.cancel_crossfade()
+
+            # If it already took over from the current player, the next song just starts over the normal way
+            prepared.discard()
+
+    def _schedule_crossfade(self):
+        entry = self._current_entry
+
+        if not self.bot.config.crossfade or not entry or self._crossfade_handle:
+            return
+
+        delay = max(0, entry.duration - self.position - self.bot.config.crossfade)
+        self._crossfade_handle = self.loop.call_later(delay, self._start_crossfade)
+
+    def _start_crossfade(self):
+        self._crossfade_handle = None
+        prepared, player, entry = self._prepared, self._current_player, self._current_entry
+
+        if not self.is_playing or not prepared or prepared.started or not player or not entry:
+            return
+
+        if self.playlist.peek() is not prepared.entry or not isinstance(player.buff, PatchedBuff) \
+                or not isinstance(prepared.player.buff, PatchedBuff):
+            return
+
+        # Short songs get a shorter fade, so it never takes over most of either one
+        length = min(self.bot.config.crossfade, entry.duration - self.position, entry.duration / 2)
+        if prepared.entry.duration:
+            length = min(length, prepared.entry.duration / 2)
+
+        if length > 0:
+            player.buff.crossfade_into(prepared.player.buff, int(length * FRAMES_PER_SECOND))
+
+    def _create_player(self, entry, start_at=0):
+        """
+            Creates the player thread for `entry`, starting `start_at` seconds into the song.  Songs with
+            cached opus frames at the right volume are sent as is, everything else goes through ffmpeg.
+        """
+        normalization_gain = self._normalization_gain(entry)
+        gain = min(self.volume * normalization_gain, 2)
+        opus_path = None
+
+        # Recordings would have the crossfade baked into them
+        if self.bot.config.opus_cache and not self.bot.config.crossfade and entry.is_downloaded and not start_at:
+            opus_path = self.playlist.downloader.audio_cache.opus_path_for(entry.filename)
+            reader = OpusFrameReader.open(opus_path)
+
+            if reader and reader.matches(gain):
+                player = OpusFramePlayer(reader, self.voice_client)
+                return self._setup_player(player)
+
+            elif reader:
+                reader.close()
+
+        if entry.is_downloaded:
+            source, before_options = entry.filename, "-nostdin"
+        else:
+            # Streaming straight from the source, so let ffmpeg deal with flaky connections
+            source = entry.stream_url
+            before_options = "-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+        if start_at:
+            before_options += " -ss %.2f" % start_at
+
+        player = self._monkeypatch_player(self.voice_client.create_ffmpeg_player(
+            source,
+            before_options=before_options,
+            options="-vn -b:a 128k"
+        ))
+        self._setup_player(player, start_at)
+        player.buff.normalization_gain = normalization_gain
+        player.buff.volume = self.volume
+
+        if opus_path:
+            # Save the frames as they're encoded, so next time we can skip all this
+            try:
+                player.opus_recorder = OpusRecorder(self.voice_client, player.buff, OpusFrameWriter(opus_path, gain))
+                player.player = player.opus_recorder
+            except OSError as e:
+                print("[OpusCache] No se pudo crear %s: %s" % (opus_path, e))
+
+        return player
+
+    def _setup_player(self, player, start_at=0):
+        # after is called from the voice playback thread
+        player.after = partial(self._player_ended, player)
+        player.start_offset = start_at
+        player.opus_recorder = None
+        player.setDaemon(True)
+        return player
+
+    def _restart_at(self, position):
+        """
+            Replaces the current player with an ffmpeg one starting at `position`.  ffmpeg gets the -ss before
+            the input, so it jumps straight there instead of decoding everything before it.
+        """
+        old_player = self._current_player
+
+        if old_player.opus_recorder:
+            # Skipping around leaves holes in the recording
+            old_player.opus_recorder.writer.abort()
+
+        old_player.after = None
+        old_player.stop()
+
+        # Let the old thread out if it's paused, it'll see it was stopped and exit
+        old_player._resumed.set()
+
+        self._current_player = self._create_player(self._current_entry, start_at=position)
+
+        if self.is_paused:
+            self._current_player.pause()
+
+        self._current_player.start()
+
+    def _normalization_gain(self, entry):
+        if not self.bot.config.normalize_volume or not entry.is_downloaded:
+            return 1.0
+
+        audio_cache = self.playlist.downloader.audio_cache
+        loudness = audio_cache.loudness_of(entry.filename)
+
+        if loudness is None:
+            # Files from before normalization was turned on, we'll know for next time
+            audio_cache.queue_analysis(entry.filename)
+            return 1.0
+
+        return gain_for(loudness, self.bot.config.normalization_target)
+
     def _monkeypatch_player(self, player):
         original_buff = player.buff
         player.buff = PatchedBuff(original_buff)
@@ -272,26 +670,23 @@ class MusicPlayer(EventEmitter):
 
     def reload_voice(self, voice_client):
         self.voice_client = voice_client
+
+        # Made for the old connection
+        self._discard_prepared()
+
         if self._current_player:
-            self._current_player.player = voice_client.play_audio
-            self._current_player._resumed.clear()
-            self._current_player._connected.set()
+            if self._current_player.opus_recorder:
+                # Some frames are going to get lost while we reconnect, so this recording is no good
+                self._current_player.opus_recorder.writer.abort()
+                self._current_player.opus_recorder = None
 
-    async def websocket_check(self):
-        if self.bot.config.debug_mode:
-            print("[Debug] Creating websocket check loop")
+            if isinstance(self._current_player, OpusFramePlayer):
+                self._current_player.voice_client = voice_client
+            else:
+                self._current_player.player = voice_client.play_audio
 
-        while not self.is_dead:
-            try:
-                self.voice_client.ws.ensure_open()
-                assert self.voice_client.ws.open
-            except:
-                if self.bot.config.debug_mode:
-                    print("[Debug] Voice websocket is %s, reconnecting" % self.voice_client.ws.state_name)
-                await self.bot.reconnect_voice_client(self.voice_client.channel.server)
-                await asyncio.sleep(4)
-            finally:
-                await asyncio.sleep(1)
+            self._current_player._resumed.clear()
+            self._current_player._connected.set()
 
     @property
     def current_entry(self):
@@ -313,13 +708,20 @@ class MusicPlayer(EventEmitter):
     def is_dead(self):
         return self.state == MusicPlayerState.DEAD
 
+    @property
+    def position(self):
+        """
+            Where playback is in the current song, in seconds.  Only counts audio that was actually read,
+            so pauses and reconnects don't throw it off.
+        """
+        if not self._current_player:
+            return 0.0
+
+        return self._current_player.start_offset + self._current_player.buff.position
+
     @property
     def progress(self):
-        return round(self._current_player.buff.frame_count * 0.02)
-        # TODO: Properly implement this
-        #       Correct calculation should be bytes_read/192k
-        #       192k AKA sampleRate * (bitDepth / 8) * channelCount
-        #       Change frame_count to bytes_read in the PatchedBuff
+        return round(self.position)
 
 
 # if redistributing ffmpeg is an issue, it can be downloaded from here:
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import traceback
 from collections import deque
@@ -6,6 +7,7 @@ from random import shuffle
 
 from .utils import get_header
 from .entry import URLPlaylistEntry
+from .queueindex import QueueIndex
 from .exceptions import ExtractionError, WrongEntryTypeError
 from .lib.event_emitter import EventEmitter
 
@@ -21,15 +23,50 @@ class Playlist(EventEmitter):
         self.loop = bot.loop
         self.downloader = bot.downloader
         self.entries = deque()
+        self._index = QueueIndex()
 
     def __iter__(self):
         return iter(self.entries)
 
+    def __len__(self):
+        return len(self.entries)
+
     def shuffle(self):
         shuffle(self.entries)
+        self._index.rebuild(self.entries)
 
     def clear(self):
+        for entry in self.entries:
+            entry.cancel_download()
+
         self.entries.clear()
+        self._index.rebuild(())
+
+    def remove(self, entry):
+        """
+            Takes `entry` out of the queue, wherever it is, and stops its download.  Returns False if it wasn't
+            queued.
+        """
+        if not self._unqueue(entry):
+            return False
+
+        entry.cancel_download()
+        return True
+
+    def _unqueue(self, entry):
+        try:
+            self.entries.remove(entry)
+        except ValueError:
+            return False
+
+        self._index.remove(entry)
+        return True
+
+    def _append(self, entry):
+        self.entries.append(entry)
+
+        if not self._index.append(entry):
+            self._index.rebuild(self.entries)
 
     async def add_entry(self, song_url, **meta):
         """
@@ -41,8 +78,17 @@ class Playlist(EventEmitter):
             :param meta: Any additional metadata to add to the playlist entry.
         """
 
+        entry = await self._make_entry(song_url, **meta)
+        self._add_entry(entry)
+        return entry, len(self.entries)
+
+    async def _make_entry(self, song_url, pool=None, **meta):
+        """
+            Validates a song_url and creates an entry for it, without adding it to the playlist.
+        """
+
         try:
-            info = await self.downloader.extract_info(self.loop, song_url, download=False)
+            info = await self.downloader.extract_info(self.loop, song_url, download=False, pool=pool)
         except Exception as e:
             raise ExtractionError('Could not extract information from {}\n\n{}'.format(song_url, e))
 
@@ -79,10 +125,11 @@ class Playlist(EventEmitter):
             info.get('title', 'Untitled'),
             info.get('duration', 0) or 0,
             self.downloader.ytdl.prepare_filename(info),
+            info.get('filesize', 0) or info.get('filesize_approx', 0) or 0,
             **meta
         )
-        self._add_entry(entry)
-        return entry, len(self.entries)
+        entry.set_resolved_info(info)
+        return entry
 
     async def import_from(self, playlist_url, **meta):
         """
@@ -120,8 +167,10 @@ class Playlist(EventEmitter):
                         items.get('title', 'Untitled'),
                         items.get('duration', 0) or 0,
                         self.downloader.ytdl.prepare_filename(items),
+                        items.get('filesize', 0) or items.get('filesize_approx', 0) or 0,
                         **meta
                     )
+                    entry.set_resolved_info(items, info.get('_resolved_at', None))
 
                     self._add_entry(entry)
                     entry_list.append(entry)
@@ -139,11 +188,13 @@ class Playlist(EventEmitter):
 
         return entry_list, position
 
-    async def async_process_youtube_playlist(self, playlist_url, **meta):
+    async def async_process_youtube_playlist(self, playlist_url, *, max_song_length=0, max_songs=0, **meta):
         """
             Processes youtube playlists links from `playlist_url` in a questionable, async fashion.
 
             :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
+            :param max_song_length: Songs longer than this many seconds are skipped
+            :param max_songs: Stop adding songs once the author has this many in the queue
             :param meta: Any additional metadata to add to the playlist entry
         """
 
@@ -155,35 +206,18 @@ class Playlist(EventEmitter):
         if not info:
             raise ExtractionError('Could not extract information from %s' % playlist_url)
 
-        gooditems = []
-        baditems = 0
-        for entry_data in info['entries']:
-            if entry_data:
-                baseurl = info['webpage_url'].split('playlist?list=')[0]
-                song_url = baseurl + 'watch?v=%s' % entry_data['id']
+        baseurl = info['webpage_url'].split('playlist?list=')[0]
+        song_urls = [(baseurl + 'watch?v=%s' % e['id'], e['id']) if e else None for e in info['entries']]
 
-                try:
-                    entry, elen = await self.add_entry(song_url, **meta)
-                    gooditems.append(entry)
-                except ExtractionError:
-                    baditems += 1
-                except Exception as e:
-                    baditems += 1
-                    print("There was an error adding the song {}: {}: {}\n".format(
-                        entry_data['id'], e.__class__.__name__, e))
-            else:
-                baditems += 1
+        return await self._ingest(song_urls, max_song_length, max_songs, meta)
 
-        if baditems:
-            print("Skipped %s bad entries" % baditems)
-
-        return gooditems
-
-    async def async_process_sc_bc_playlist(self, playlist_url, **meta):
+    async def async_process_sc_bc_playlist(self, playlist_url, *, max_song_length=0, max_songs=0, **meta):
         """
             Processes soundcloud set and bancdamp album links from `playlist_url` in a questionable, async fashion.
 
             :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
+            :param max_song_length: Songs longer than this many seconds are skipped
+            :param max_songs: Stop adding songs once the author has this many in the queue
             :param meta: Any additional metadata to add to the playlist entry
         """
 
@@ -195,55 +229,209 @@ class Playlist(EventEmitter):
         if not info:
             raise ExtractionError('Could not extract information from %s' % playlist_url)
 
+        song_urls = [(e['url'], e.get('id', e['url'])) if e else None for e in info['entries']]
+
+        return await self._ingest(song_urls, max_song_length, max_songs, meta)
+
+    async def _ingest(self, song_urls, max_song_length, max_songs, meta):
+        """
+            Resolves `song_urls`, a list of (url, id) tuples or None for bad items, with up to
+            `config.playlist_concurrency` lookups in flight.  Entries are added to the playlist in their
+            original order as soon as everything in front of them is resolved, so playback can start right away.
+        """
+        concurrency = max(1, self.bot.config.playlist_concurrency)
+        author = meta.get('author', None)
+
+        pending = deque()
         gooditems = []
         baditems = 0
-        for entry_data in info['entries']:
-            if entry_data:
-                song_url = entry_data['url']
+        too_long = 0
+
+        def start_next(items):
+            item = next(items, False)
+
+            if item is False:
+                return False
+
+            if item:
+                song_url, song_id = item
+                task = asyncio.ensure_future(self._make_entry(song_url, pool='prefetch', **meta), loop=self.loop)
+                pending.append((song_id, task))
+            else:
+                pending.append((None, None))
+
+            return True
+
+        items = iter(song_urls)
+        try:
+            while len(pending) < concurrency and start_next(items):
+                pass
+
+            while pending:
+                song_id, task = pending.popleft()
+                start_next(items)
+
+                if not task:
+                    baditems += 1
+                    continue
 
                 try:
-                    entry, elen = await self.add_entry(song_url, **meta)
-                    gooditems.append(entry)
+                    entry = await task
+
                 except ExtractionError:
                     baditems += 1
+                    continue
+
                 except Exception as e:
                     baditems += 1
                     print("There was an error adding the song {}: {}: {}\n".format(
-                        entry_data['id'], e.__class__.__name__, e))
-            else:
-                baditems += 1
+                        song_id, e.__class__.__name__, e))
+                    continue
+
+                if max_song_length and entry.duration > max_song_length:
+                    too_long += 1
+                    continue
+
+                if max_songs and self.count_for_user(author) >= max_songs:
+                    print("Max songs reached, not adding the rest of the playlist")
+                    break
+
+                self._add_entry(entry)
+                gooditems.append(entry)
+
+        finally:
+            for _, task in pending:
+                if task:
+                    task.cancel()
 
         if baditems:
             print("Skipped %s bad entries" % baditems)
 
+        if too_long:
+            print("Skipped %s entries over the max song length" % too_long)
+
         return gooditems
 
     def _add_entry(self, entry):
-        self.entries.append(entry)
+        self._append(entry)
         self.emit('entry-added', playlist=self, entry=entry)
 
         if self.peek() is entry:
+            self._warm_up(entry)
+
+        self._prefetch()
+
+    def _warm_up(self, entry):
+        """
+            Gets `entry` ready to be played soon.  Normally that means downloading it, but when streaming we
+            only need the media url, unless we're also filling the audio cache.
+        """
+        if self.bot.config.stream_mode and not self.bot.config.stream_tee_cache:
+            if not entry.is_downloaded:
+                asyncio.ensure_future(entry.resolve_stream_url(), loop=self.loop)
+        else:
             entry.get_ready_future()
 
-    async def get_next_entry(self, predownload_next=True):
+    def _prefetch(self):
+        """
+            Downloads the songs after the next one in the background, so slow extractors don't leave gaps
+            between songs.  Only looks `config.prefetch_count` songs ahead, and stops once the songs would
+            start playing more than `config.prefetch_max_time` seconds from now or would need more than
+            `config.prefetch_max_size` MB of downloads.
+        """
+        config = self.bot.config
+
+        if config.prefetch_count < 2 or (config.stream_mode and not config.stream_tee_cache):
+            return
+
+        max_bytes = config.prefetch_max_size * 1024 * 1024
+        start_time = 0
+        wanted = []
+
+        # The first one is the next song up, which _warm_up already takes care of
+        for i, entry in enumerate(islice(self.entries, 0, config.prefetch_count)):
+            if config.prefetch_max_time and start_time > config.prefetch_max_time:
+                break
+
+            start_time += entry.duration
+
+            if not i:
+                continue
+
+            if entry.is_downloaded or entry.is_downloading:
+                # Already part of the budget, whichever call started them
+                max_bytes -= entry.estimated_size
+            else:
+                wanted.append(entry)
+
+        for entry in wanted:
+            if config.prefetch_max_size:
+                if entry.estimated_size > max_bytes:
+                    break
+
+                max_bytes -= entry.estimated_size
+
+            entry.get_ready_future(pool='prefetch')
+
+    async def get_next_entry(self, predownload_next=True, *, stream=False):
         """
             A coroutine which will return the next song or None if no songs left to play.
 
             Additionally, if predownload_next is set to True, it will attempt to download the next
             song to be played - so that it's ready by the time we get to it.
+
+            If stream is True and the song isn't downloaded yet, this only resolves its media url instead
+            of waiting for the whole download.
         """
         if not self.entries:
             return None
 
         entry = self.entries.popleft()
+        self._index.remove(entry)
 
         if predownload_next:
-            next_entry = self.peek()
-            if next_entry:
-                next_entry.get_ready_future()
+            self._warm_up_next()
+
+        if stream and not entry.is_downloaded:
+            await entry.resolve_stream_url()
+            self._tee(entry)
+            return entry
 
         return await entry.get_ready_future()
 
+    def restore(self, entries):
+        """
+            Puts back the entries of a saved queue, see QueueJournal.
+        """
+        for entry in entries:
+            self._append(entry)
+
+        self._warm_up_next()
+
+    def take(self, entry, *, stream=False):
+        """
+            Takes `entry` out of the queue because the player already has it ready to play (see gapless
+            playback in MusicPlayer), and gets the songs after it ready.
+        """
+        # Still wanted, it's about to play
+        self._unqueue(entry)
+        self._warm_up_next()
+
+        if stream and not entry.is_downloaded:
+            self._tee(entry)
+
+    def _warm_up_next(self):
+        next_entry = self.peek()
+        if next_entry:
+            self._warm_up(next_entry)
+
+        self._prefetch()
+
+    def _tee(self, entry):
+        if self.bot.config.stream_tee_cache:
+            # Download it in the background too, so the next time it's played from the cache
+            entry.get_ready_future(pool='prefetch')
+
     def peek(self):
         """
             Returns the next entry that should be scheduled to be played.
@@ -255,15 +443,22 @@ class Playlist(EventEmitter):
         """
             (very) Roughly estimates the time till the queue will 'position'
         """
-        estimated_time = sum([e.duration for e in islice(self.entries, position - 1)])
+        estimated_time = self._index.duration_until(position - 1)
 
         # When the player plays a song, it eats the first playlist item, so we just have to add the time back
         if not player.is_stopped and player.current_entry:
-            estimated_time += player.current_entry.duration - player.progress
+            estimated_time += player.current_entry.duration - player.position
 
         return datetime.timedelta(seconds=estimated_time)
 
+    @property
+    def total_duration(self):
+        return self._index.total_duration
+
     def count_for_user(self, user):
-        return sum(1 for e in self.entries if e.meta.get('author', None) == user)
+        return self._index.count_for(user)
+
+    def duration_for_user(self, user):
+        return self._index.duration_for(user)
 
 
@@ -0,0 +1,157 @@
+class FenwickTree:
+    """
+        Prefix sums over a fixed number of slots, with O(log n) updates and queries.
+    """
+
+    __slots__ = ['tree']
+
+    def __init__(self, values):
+        tree = [0]
+        tree.extend(values)
+
+        # Building it in place is O(n), instead of n updates
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] += tree[i]
+
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, slot, delta):
+        tree = self.tree
+        i = slot + 1
+
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, slots):
+        """
+            Returns the sum of the first `slots` slots.
+        """
+        tree = self.tree
+        total = 0
+
+        while slots > 0:
+            total += tree[slots]
+            slots -= slots & -slots
+
+        return total
+
+    def slots_for(self, total):
+        """
+            Returns the fewest leading slots that add up to at least `total`, for trees without negative values.
+        """
+        tree = self.tree
+        pos = 0
+        step = 1 << (len(tree) - 1).bit_length()
+
+        while step:
+            nxt = pos + step
+
+            if nxt < len(tree) and tree[nxt] < total:
+                pos = nxt
+                total -= tree[nxt]
+
+            step >>= 1
+
+        return pos + 1 if total > 0 else pos
+
+
+class QueueIndex:
+    """
+        Running totals over the entries of a queue, so the playlist can answer how long until the nth song and
+        how much of the queue is someone's without going through all of it.
+
+        Every entry added gets the next slot in a pair of fenwick trees holding a count and the duration of the
+        entry in that slot.  Entries leaving the queue, from the front or anywhere else, just zero their slot,
+        so the order of the queue is the order of the slots.  Once the slots run out the trees are rebuilt with
+        room to spare, as they are when the queue is reordered.
+    """
+
+    MIN_CAPACITY = 64
+
+    def __init__(self):
+        self.rebuild(())
+
+    def rebuild(self, entries):
+        entries = list(entries)
+        capacity = max(self.MIN_CAPACITY, len(entries) * 2)
+        padding = [0] * (capacity - len(entries))
+
+        self._slots = {id(e): slot for slot, e in enumerate(entries)}
+        self._next_slot = len(entries)
+        self._counts = FenwickTree([1] * len(entries) + padding)
+        self._durations = FenwickTree([e.duration for e in entries] + padding)
+
+        self.total_duration = 0
+        self._authors = {}
+
+        for entry in entries:
+            self._update_author(entry, 1)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _update_author(self, entry, sign):
+        self.total_duration += entry.duration * sign
+
+        author = entry.meta.get('author', None)
+        if author is None:
+            return
+
+        count, duration = self._authors.get(author, (0, 0))
+        count += sign
+        duration += entry.duration * sign
+
+        if count:
+            self._authors[author] = (count, duration)
+        else:
+            self._authors.pop(author, None)
+
+    def append(self, entry):
+        """
+            Indexes an entry added to the end of the queue.  Returns False if there's no slot left for it, in
+            which case the index should be rebuilt from the queue instead.
+        """
+        if self._next_slot >= len(self._counts):
+            return False
+
+        slot = self._next_slot
+        self._next_slot += 1
+        self._slots[id(entry)] = slot
+
+        self._counts.add(slot, 1)
+        self._durations.add(slot, entry.duration)
+        self._update_author(entry, 1)
+        return True
+
+    def remove(self, entry):
+        slot = self._slots.pop(id(entry), None)
+        if slot is None:
+            return
+
+        self._counts.add(slot, -1)
+        self._durations.add(slot, -entry.duration)
+        self._update_author(entry, -1)
+
+    def duration_until(self, position):
+        """
+            Returns the total duration of the first `position` entries of the queue.
+        """
+        if position <= 0:
+            return 0
+
+        if position >= len(self._slots):
+            return self.total_duration
+
+        return self._durations.prefix(self._counts.slots_for(position))
+
+    def count_for(self, author):
+        return self._authors.get(author, (0, 0))[0]
+
+    def duration_for(self, author):
+        return self._authors.get(author, (0, 0))[1]
@@ -0,0 +1,154 @@
+import os
+import threading
+import traceback
+
+from .constructs import pack, Unpacker
+
+
+class QueueJournal:
+    """
+        An append only log of the queue of every server, so queues survive restarts and crashes.
+
+        Each record is for one server, encoded with constructs.pack after a short header.  Changes to the queue
+        are written as a full snapshot of it, while the position in the current song, which changes all the
+        time, gets its own tiny record:
+
+            {"s": server_id, "q": {...}}    the queue (voice channel, current entry and the rest)
+            {"s": server_id, "p": 12.3}     how far into the current entry playback is
+            {"s": server_id, "q": null}     the queue was dropped
+
+        Replaying the file gives the latest state of each server.  The file is rewritten with just that once
+        most of it is outdated records.
+    """
+
+    MAGIC = b'MBQJ\x01'
+
+    # Rewrite the file once it has this many times more records than servers with a queue
+    COMPACT_RATIO = 8
+    MIN_COMPACT_RECORDS = 256
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._states = {}
+        self._records = 0
+        self._needs_rewrite = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+            Reads the journal and returns {server_id: state}, where state is the last queue snapshot with the
+            last known position in it.
+        """
+        states = {}
+        records = 0
+        self._needs_rewrite = False
+
+        try:
+            with open(self.filename, 'rb') as f:
+                if f.read(len(self.MAGIC)) == self.MAGIC:
+                    unpacker = Unpacker(f)
+                    for record in unpacker:
+                        self._apply(states, record)
+                        records += 1
+
+                    # Most likely the last record, cut short by a crash.  Appending after it would garble the rest.
+                    self._needs_rewrite = bool(unpacker.truncated)
+
+                else:
+                    # Empty or not a journal at all, either way it gets replaced on the next write
+                    self._needs_rewrite = True
+
+        except FileNotFoundError:
+            pass
+
+        except Exception:
+            traceback.print_exc()
+            print("[QueueJournal] No se pudo leer %s" % self.filename)
+            self._needs_rewrite = True
+
+        self._states = states
+        self._records = records
+        return {server_id: dict(state) for server_id, state in states.items()}
+
+    @staticmethod
+    def _apply(states, record):
+        server_id = record['s']
+
+        if 'q' in record:
+            if record['q'] is None:
+                states.pop(server_id, None)
+            else:
+                states[server_id] = dict(record['q'], position=0)
+
+        elif 'p' in record and server_id in states:
+            states[server_id]['position'] = record['p']
+
+    @staticmethod
+    def queue_record(server_id, state):
+        return {'s': server_id, 'q': state}
+
+    @staticmethod
+    def position_record(server_id, position):
+        return {'s': server_id, 'p': position}
+
+    def write(self, records):
+        """
+            Appends `records` to the journal, compacting it instead if it's time.  Safe to call from an executor.
+        """
+        if not records:
+            return
+
+        with self._lock:
+            self._write(records)
+
+    def _write(self, records):
+        for record in records:
+            self._apply(self._states, record)
+
+        self._records += len(records)
+
+        if self._needs_rewrite or self._records > max(self.MIN_COMPACT_RECORDS, len(self._states) * self.COMPACT_RATIO):
+            self._compact()
+            return
+
+        self._ensure_folder()
+
+        with open(self.filename, 'ab') as f:
+            if not f.tell():
+                f.write(self.MAGIC)
+
+            f.write(b''.join(pack(r) for r in records))
+
+    def compact(self):
+        """
+            Rewrites the journal with a single snapshot per server.
+        """
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        records = []
+
+        for server_id, state in self._states.items():
+            state = dict(state)
+            position = state.pop('position', 0)
+
+            records.append(self.queue_record(server_id, state))
+            if position:
+                records.append(self.position_record(server_id, position))
+
+        self._ensure_folder()
+
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(b''.join(pack(r) for r in records))
+
+        os.replace(tmpfile, self.filename)
+        self._records = len(records)
+        self._needs_rewrite = False
+
+    def _ensure_folder(self):
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
@@ -41,6 +41,30 @@ def sane_round_int(x):
     return int(decimal.Decimal(x).quantize(1, rounding=decimal.ROUND_HALF_UP))
 
 
+def parse_timestamp(text):
+    """
+    Turns a timestamp like 1:02:03, 2:03 or 123.5 into seconds.  Only the last part may have a fraction,
+    and every part but the first has to be under 60.
+    """
+    parts = text.split(':')
+
+    if len(parts) > 3 or not all(re.fullmatch(r'\d+', part) for part in parts[:-1]) \
+            or not re.fullmatch(r'\d+(\.\d+)?', parts[-1]):
+        raise ValueError("%s is not a timestamp" % text)
+
+    seconds = 0.0
+
+    for i, part in enumerate(parts):
+        value = float(part)
+
+        if i and value >= 60:
+            raise ValueError("%s is not a timestamp" % text)
+
+        seconds = seconds * 60 + value
+
+    return seconds
+
+
 def paginate(content, *, length=DISCORD_MSG_CHAR_LIMIT, reserve=0):
     """
     Split up a large string or list of strings into chunks for sending to discord.
@@ -68,6 +92,29 @@ def paginate(content, *, length=DISCORD_MSG_CHAR_LIMIT, reserve=0):
     return chunks
 
 
+def objdiff(obj1, obj2, *, access_attr=None):
+    """
+    Returns {attribute: (old, new)} for the attributes that differ between two objects.  `access_attr` names
+    the attribute listing what to compare, like '__slots__', otherwise everything dir() finds is compared.
+    """
+    if access_attr:
+        names = set(getattr(obj1, access_attr, ())) | set(getattr(obj2, access_attr, ()))
+    else:
+        names = set(dir(obj1)) | set(dir(obj2))
+
+    missing = object()
+    changes = {}
+
+    for name in names:
+        old = getattr(obj1, name, missing)
+        new = getattr(obj2, name, missing)
+
+        if old is not new and old != new:
+            changes[name] = (None if old is missing else old, None if new is missing else new)
+
+    return changes
+
+
 async def get_header(session, url, headerfield=None, *, timeout=5):
     with aiohttp.Timeout(timeout):
         async with session.head(url) as response:
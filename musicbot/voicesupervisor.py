@@ -0,0 +1,216 @@
+import time
+import random
+import asyncio
+import traceback
+
+from enum import Enum
+
+
+class VoiceConnectionStatus(Enum):
+    CONNECTED = 0     # The voice websocket is open, or we haven't noticed otherwise
+    RECONNECTING = 1  # A reconnect is in progress
+    BACKING_OFF = 2   # The last reconnect failed, waiting to try again
+    FAILED = 3        # Gave up reconnecting, until the bot is connected to the server again
+
+    def __str__(self):
+        return self.name
+
+
+class VoiceConnectionState:
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.status = VoiceConnectionStatus.CONNECTED
+        self.attempts = 0
+        self.last_error = None
+        self.retry_at = None
+        self.task = None
+
+    @property
+    def busy(self):
+        return bool(self.task and not self.task.done())
+
+    def __repr__(self):
+        return "<VoiceConnectionState: %s %s (%s attempts)>" % (self.server_id, self.status, self.attempts)
+
+
+class VoiceSupervisor:
+    """
+        Watches every voice connection of the bot from a single task.
+
+        A connection is reconnected as soon as its websocket reports it closed, when something calls `notify`
+        for its server (e.g. a region change), or if a periodic sweep finds it closed without anyone noticing.
+        Failed reconnects are retried with jittered exponential backoff, and only `max_concurrent` reconnects
+        run at once, so a lot of servers dropping at the same time doesn't turn into a storm against the gateway.
+
+        Servers are tracked by id, since a failed reconnect can leave a server with a player but no voice client.
+        After `max_attempts` failures a server is left alone until something connects to it again.
+    """
+
+    def __init__(self, bot, *, check_interval=15, base_delay=1, max_delay=120, max_attempts=8, max_concurrent=2):
+        self.bot = bot
+        self.loop = bot.loop
+        self.check_interval = check_interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+        self.connections = {}
+        self._forced = set()
+        self._wake = asyncio.Event()
+        self._reconnect_semaphore = asyncio.Semaphore(max_concurrent)
+        self._task = None
+
+    def start(self):
+        if not self._task or self._task.done():
+            self._task = self.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+        for state in self.connections.values():
+            if state.busy:
+                state.task.cancel()
+
+    def state_for(self, server_id):
+        if server_id not in self.connections:
+            self.connections[server_id] = VoiceConnectionState(server_id)
+
+        return self.connections[server_id]
+
+    def watch(self, voice_client):
+        """
+            Starts watching a freshly connected voice client, so its websocket closing is noticed right away.
+        """
+        server_id = voice_client.channel.server.id
+        state = self.state_for(server_id)
+
+        if state.status is VoiceConnectionStatus.FAILED:
+            # Someone got it connected again, so it's fair game for reconnects again
+            state.status = VoiceConnectionStatus.CONNECTED
+            state.attempts = 0
+            state.last_error = None
+
+        # websockets exposes when the connection is gone as a future, but the name depends on the version
+        ws = voice_client.ws
+        closed = getattr(ws, 'connection_closed', None) or getattr(ws, 'connection_lost_waiter', None)
+
+        if isinstance(closed, asyncio.Future):
+            closed.add_done_callback(lambda f: self._on_closed(server_id, voice_client))
+
+    def forget(self, server_id):
+        """
+            Stops supervising a server, for when we leave its voice channel on purpose.
+        """
+        state = self.connections.pop(server_id, None)
+        self._forced.discard(server_id)
+
+        if state and state.busy:
+            state.task.cancel()
+
+    def notify(self, server_id, *, force=False):
+        """
+            Asks for the connection of a server to be checked now.  With `force` it's reconnected even if it
+            looks healthy, which is what a region change needs.
+        """
+        if force:
+            self._forced.add(server_id)
+
+        self._wake.set()
+
+    def _on_closed(self, server_id, voice_client):
+        # Disconnects we did on purpose already took the client out of the_voice_clients
+        if self.bot.the_voice_clients.get(server_id, None) is voice_client:
+            if self.bot.config.debug_mode:
+                print("[Debug] Voice websocket for %s closed, reconnecting" % server_id)
+
+            self.notify(server_id, force=True)
+
+    @staticmethod
+    def _is_open(voice_client):
+        ws = getattr(voice_client, 'ws', None)
+        return bool(ws and ws.open)
+
+    def backoff(self, attempts):
+        """
+            Half of the exponential delay is fixed and the other half random, so retries spread out but
+            never happen right away.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.check_interval, loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wake.clear()
+
+            if self.bot.voice_client_connect_lock.locked():
+                # Clients that are still connecting look closed, so the sweep waits until they're done
+                with await self.bot.voice_client_connect_lock:
+                    pass
+
+            forced, self._forced = self._forced, set()
+
+            # Including servers whose voice client got lost halfway through a reconnect
+            for server_id in set(self.bot.the_voice_clients).union(self.connections):
+                state = self.connections.get(server_id, None)
+
+                if state and state.status is VoiceConnectionStatus.FAILED:
+                    continue
+
+                if server_id in forced or not self._is_open(self.bot.the_voice_clients.get(server_id, None)):
+                    self._schedule(server_id)
+
+    def _schedule(self, server_id):
+        state = self.state_for(server_id)
+
+        if not state.busy:
+            state.task = self.loop.create_task(self._reconnect(state))
+
+    async def _reconnect(self, state):
+        while True:
+            server = self.bot.get_server(state.server_id)
+
+            if not server or (state.server_id not in self.bot.the_voice_clients and state.server_id not in self.bot.players):
+                self.connections.pop(state.server_id, None)
+                return
+
+            state.status = VoiceConnectionStatus.RECONNECTING
+            state.retry_at = None
+
+            try:
+                with await self._reconnect_semaphore:
+                    await self.bot.reconnect_voice_client(server)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                if self.bot.config.debug_mode:
+                    traceback.print_exc()
+
+                state.attempts += 1
+                state.last_error = e
+
+                if state.attempts >= self.max_attempts:
+                    state.status = VoiceConnectionStatus.FAILED
+                    print("[Voz] No se pudo reconectar a %s después de %s intentos" % (server.name, state.attempts))
+                    return
+
+                delay = self.backoff(state.attempts)
+                state.status = VoiceConnectionStatus.BACKING_OFF
+                state.retry_at = time.time() + delay
+
+                print("[Voz] Error al reconectar a %s, reintentando en %.1f segundos" % (server.name, delay))
+                await asyncio.sleep(delay)
+
+            else:
+                state.status = VoiceConnectionStatus.CONNECTED
+                state.attempts = 0
+                state.last_error = None
+                return
@@ -0,0 +1,148 @@
+import io
+import math
+import random
+import unittest
+
+from musicbot.constructs import IncompleteData, Serializable, Unpacker, pack, unpack
+
+
+class Point(Serializable):
+    def __init__(self, x, y, label=None):
+        self.x = x
+        self.y = y
+        self.label = label
+
+    def __json__(self):
+        return self._enclose_json({'x': self.x, 'y': self.y})
+
+    @classmethod
+    def _deserialize(cls, data, label=None):
+        return cls(data['x'], data['y'], label)
+
+
+VALUES = [
+    None, True, False, 0, 1, 127, 128, 2 ** 64 + 5, -1, -300, 0.5, -2.25, 1e300,
+    '', 'a', 'ñandú ♪', 'x' * 200, b'', b'\x00\xff' * 40,
+    [], {}, [1, [2, [3, []]]], {'a': {'b': {'c': None}}},
+    {'title': 'song', 'duration': 215, 'meta': {'author': '1234', 'channel': '5678'}},
+]
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(9 if depth < 4 else 6)
+
+    if kind == 0:
+        return rng.choice([None, True, False])
+    if kind == 1:
+        return rng.randint(-2 ** 40, 2 ** 40)
+    if kind == 2:
+        return rng.uniform(-1e6, 1e6)
+    if kind == 3:
+        # Few distinct strings, so plenty of them are shared
+        return rng.choice(['url', 'title', 'duration', 'meta', 'y' * 70, 'é'])
+    if kind == 4:
+        return ''.join(chr(rng.randint(32, 0x2fff)) for _ in range(rng.randint(0, 20)))
+    if kind == 5:
+        return bytes(rng.randrange(256) for _ in range(rng.randint(0, 10)))
+    if kind in (6, 7):
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+
+    return {random_value(rng, 4) if rng.random() < 0.2 else rng.choice(['url', 'title', 'meta']) + str(i):
+            random_value(rng, depth + 1) for i in range(rng.randint(0, 5))}
+
+
+class PackTest(unittest.TestCase):
+    def test_round_trip(self):
+        for value in VALUES:
+            self.assertEqual(unpack(pack(value)), value)
+
+    def test_random_round_trip(self):
+        rng = random.Random(5)
+
+        for _ in range(300):
+            value = random_value(rng)
+            self.assertEqual(unpack(pack(value)), value)
+
+    def test_tuples_come_back_as_lists(self):
+        self.assertEqual(unpack(pack((1, (2, 3)))), [1, [2, 3]])
+
+    def test_special_floats(self):
+        self.assertEqual(unpack(pack(float('inf'))), float('inf'))
+        self.assertTrue(math.isnan(unpack(pack(float('nan')))))
+
+    def test_shared_strings_are_smaller(self):
+        entry = {'title': 'song', 'duration': 215, 'meta': {'author': '1234'}}
+        one = len(pack([entry]))
+        many = len(pack([entry] * 10))
+
+        self.assertLess(many - one, (one - 2) * 9)
+
+    def test_serializable(self):
+        point = unpack(pack({'p': Point(1, -2)}), label='here')['p']
+
+        self.assertIsInstance(point, Point)
+        self.assertEqual((point.x, point.y, point.label), (1, -2, 'here'))
+
+    def test_unknown_class(self):
+        data = pack(Point(3, 4)).replace(b'Point', b'Pxint')
+
+        self.assertEqual(unpack(data), {'__class__': 'Pxint', '__module__': __name__, 'data': {'x': 3, 'y': 4}})
+
+    def test_not_serializable(self):
+        with self.assertRaises(TypeError):
+            pack(object())
+
+    def test_truncated(self):
+        data = pack(VALUES)
+
+        for end in range(len(data)):
+            with self.assertRaises(IncompleteData):
+                unpack(data[:end])
+
+    def test_extra_data(self):
+        with self.assertRaises(ValueError):
+            unpack(pack(1) + pack(2))
+
+
+class UnpackerTest(unittest.TestCase):
+    def unpacker(self, data, chunk_size):
+        unpacker = Unpacker(io.BytesIO(data))
+        unpacker.CHUNK_SIZE = chunk_size
+        return unpacker
+
+    def test_stream(self):
+        data = b''.join(pack(v) for v in VALUES)
+
+        for chunk_size in (1, 2, 7, 64, 1 << 16):
+            unpacker = self.unpacker(data, chunk_size)
+
+            self.assertEqual(list(unpacker), VALUES)
+            self.assertEqual(unpacker.truncated, 0)
+
+    def test_value_larger_than_a_chunk(self):
+        values = ['z' * 5000, list(range(3000)), 'end']
+        unpacker = self.unpacker(b''.join(pack(v) for v in values), 64)
+
+        self.assertEqual(list(unpacker), values)
+
+    def test_truncated_last_value(self):
+        records = [{'s': str(i), 'p': i * 1.5} for i in range(20)]
+        data = b''.join(pack(r) for r in records)
+        last = len(pack(records[-1]))
+
+        for cut in range(1, last):
+            for chunk_size in (3, 1 << 16):
+                unpacker = self.unpacker(data[:-cut], chunk_size)
+
+                self.assertEqual(list(unpacker), records[:-1])
+                self.assertEqual(unpacker.truncated, 1)
+
+    def test_empty(self):
+        unpacker = self.unpacker(b'', 16)
+
+        self.assertEqual(list(unpacker), [])
+        self.assertEqual(unpacker.truncated, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import random
+import unittest
+
+from array import array
+
+from musicbot import dsp
+
+
+SAMPLE_MIN, SAMPLE_MAX = -32768, 32767
+
+
+def clip(value):
+    return max(SAMPLE_MIN, min(SAMPLE_MAX, value))
+
+
+def reference_gain(samples, start, target):
+    # Ramps linearly from `start` to `target`, reaching `target` on the last sample
+    count = len(samples)
+    return [clip(int(s * (start + (target - start) * (i + 1) / count))) for i, s in enumerate(samples)]
+
+
+def frame_of(samples):
+    return array('h', samples).tobytes()
+
+
+def samples_of(frame):
+    return list(array('h', frame))
+
+
+def random_samples(rng, count=1920, loud=False):
+    bound = SAMPLE_MAX if loud else 8000
+    return [rng.randint(-bound - 1, bound) for _ in range(count)]
+
+
+def gain_stages():
+    stages = [dsp.GainStage]
+
+    if dsp.audioop is not None:
+        stages.append(dsp.AudioopGainStage)
+
+    if dsp.np is not None:
+        stages.append(dsp.NumpyGainStage)
+
+    return stages
+
+
+def mixers():
+    mixers = [dsp.Mixer]
+
+    if dsp.audioop is not None:
+        mixers.append(dsp.AudioopMixer)
+
+    if dsp.np is not None:
+        mixers.append(dsp.NumpyMixer)
+
+    return mixers
+
+
+class GainStageTest(unittest.TestCase):
+    def assertClose(self, actual, expected, tolerance):
+        self.assertEqual(len(actual), len(expected))
+        worst = max((abs(a - e) for a, e in zip(actual, expected)), default=0)
+        self.assertLessEqual(worst, tolerance)
+
+    def tolerance(self, cls):
+        # numpy works in float32 and audioop rounds down instead of towards zero
+        return 0 if cls is dsp.GainStage else 1
+
+    def test_constant_gain(self):
+        rng = random.Random(1)
+
+        for cls in gain_stages():
+            for gain in (0.0, 0.25, 0.5, 1.0, 1.5, 2.0):
+                with self.subTest(cls=cls.__name__, gain=gain):
+                    stage = cls(gain)
+                    samples = random_samples(rng, loud=True)
+
+                    out = samples_of(stage.process(frame_of(samples)))
+                    self.assertClose(out, reference_gain(samples, gain, gain), self.tolerance(cls))
+
+    def test_clipping(self):
+        samples = [SAMPLE_MAX, SAMPLE_MIN, 30000, -30000, 20000, -20000, 100, -100]
+
+        expected = [SAMPLE_MAX, SAMPLE_MIN, SAMPLE_MAX, SAMPLE_MIN, SAMPLE_MAX, SAMPLE_MIN, 200, -200]
+
+        for cls in gain_stages():
+            with self.subTest(cls=cls.__name__):
+                out = samples_of(cls(2.0).process(frame_of(samples)))
+                self.assertClose(out, expected, self.tolerance(cls))
+
+    def test_unity_gain_is_untouched(self):
+        frame = frame_of(random_samples(random.Random(2)))
+
+        for cls in gain_stages():
+            with self.subTest(cls=cls.__name__):
+                self.assertIs(cls(1.0).process(frame), frame)
+
+    def test_empty_frame(self):
+        for cls in gain_stages():
+            with self.subTest(cls=cls.__name__):
+                stage = cls(0.5)
+                stage.gain = 1.5
+
+                self.assertEqual(stage.process(b''), b'')
+
+                # The empty frame didn't use up the ramp
+                start = 1.5 if cls is dsp.AudioopGainStage else 0.5
+                samples = random_samples(random.Random(3))
+                out = samples_of(stage.process(frame_of(samples)))
+                self.assertClose(out, reference_gain(samples, start, 1.5), 1)
+
+    def test_ramp(self):
+        rng = random.Random(4)
+
+        # audioop can't ramp, it jumps straight to the new gain
+        for cls in (c for c in gain_stages() if c is not dsp.AudioopGainStage):
+            with self.subTest(cls=cls.__name__):
+                stage = cls(0.2)
+                stage.gain = 1.8
+
+                # Rounding of the ramp steps can differ a bit from the reference
+                samples = random_samples(rng, loud=True)
+                out = samples_of(stage.process(frame_of(samples)))
+                self.assertClose(out, reference_gain(samples, 0.2, 1.8), 1)
+
+                # Already there on the next frame
+                samples = random_samples(rng)
+                out = samples_of(stage.process(frame_of(samples)))
+                self.assertClose(out, reference_gain(samples, 1.8, 1.8), self.tolerance(cls))
+
+    def test_reset_skips_the_ramp(self):
+        samples = random_samples(random.Random(5))
+
+        for cls in gain_stages():
+            with self.subTest(cls=cls.__name__):
+                stage = cls(0.2)
+                stage.gain = 0.7
+                stage.reset()
+
+                out = samples_of(stage.process(frame_of(samples)))
+                self.assertClose(out, reference_gain(samples, 0.7, 0.7), self.tolerance(cls))
+
+    def test_gain_is_bounded(self):
+        stage = dsp.GainStage(5.0, max_gain=2.0)
+        self.assertEqual(stage.gain, 2.0)
+
+        stage.gain = -1
+        self.assertEqual(stage.gain, 0.0)
+
+    def test_rms(self):
+        samples = random_samples(random.Random(6), loud=True)
+        expected = int((sum(s * s for s in samples) / len(samples)) ** 0.5)
+
+        for cls in gain_stages():
+            with self.subTest(cls=cls.__name__):
+                self.assertAlmostEqual(cls().rms(frame_of(samples)), expected, delta=1)
+                self.assertEqual(cls().rms(b''), 0)
+
+    def test_create_gain_stage(self):
+        self.assertIn(type(dsp.create_gain_stage()), gain_stages())
+
+
+class MixerTest(unittest.TestCase):
+    def test_mix(self):
+        rng = random.Random(7)
+
+        for cls in mixers():
+            for other_count in (1920, 1000, 0):
+                with self.subTest(cls=cls.__name__, other=other_count):
+                    samples = random_samples(rng, loud=True)
+                    other = random_samples(rng, other_count, loud=True)
+
+                    expected = [clip(a + b) for a, b in zip(samples, other)] + samples[len(other):]
+                    self.assertEqual(samples_of(cls().mix(frame_of(samples), frame_of(other))), expected)
+
+    def test_longer_other_is_cut(self):
+        samples = [1, 2, 3]
+
+        for cls in mixers():
+            with self.subTest(cls=cls.__name__):
+                self.assertEqual(samples_of(cls().mix(frame_of(samples), frame_of([10, 20, 30, 40]))), [11, 22, 33])
+
+
+class FadeTest(unittest.TestCase):
+    def test_fade_in_and_out(self):
+        samples = [10000] * 960
+        frame = frame_of(samples)
+
+        for fade_in in (True, False):
+            with self.subTest(fade_in=fade_in):
+                fade = dsp.Fade(4, fade_in=fade_in)
+                peaks = []
+
+                while not fade.done:
+                    peaks.append(samples_of(fade.process(frame))[-1])
+
+                self.assertEqual(len(peaks), 4)
+                self.assertEqual(peaks, sorted(peaks, reverse=not fade_in))
+                self.assertAlmostEqual(peaks[-1], 10000 if fade_in else 0, delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
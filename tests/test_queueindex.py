@@ -0,0 +1,119 @@
+import random
+import unittest
+
+from musicbot.queueindex import FenwickTree, QueueIndex
+
+
+class Entry:
+    def __init__(self, duration, author=None):
+        self.duration = duration
+        self.meta = {'author': author} if author is not None else {}
+
+    def __repr__(self):
+        return "<Entry %s %s>" % (self.duration, self.meta.get('author', None))
+
+
+class FenwickTreeTest(unittest.TestCase):
+    def test_prefix_and_slots_for(self):
+        rng = random.Random(3)
+        values = [rng.randint(0, 9) for _ in range(100)]
+        tree = FenwickTree(values)
+
+        for _ in range(200):
+            slot = rng.randrange(len(values))
+            delta = rng.randint(0, 5)
+            values[slot] += delta
+            tree.add(slot, delta)
+
+            for slots in (0, 1, slot, slot + 1, len(values)):
+                self.assertEqual(tree.prefix(slots), sum(values[:slots]))
+
+            total = rng.randint(1, sum(values) or 1)
+            expected = next((i + 1 for i in range(len(values)) if sum(values[:i + 1]) >= total), len(values))
+            self.assertEqual(tree.slots_for(total), expected)
+
+        self.assertEqual(tree.slots_for(0), 0)
+
+
+class QueueIndexTest(unittest.TestCase):
+    AUTHORS = ('a', 'b', 'c', None)
+
+    def assertMatches(self, index, queue):
+        self.assertEqual(len(index), len(queue))
+        self.assertEqual(index.total_duration, sum(e.duration for e in queue))
+
+        for position in range(len(queue) + 2):
+            self.assertEqual(index.duration_until(position), sum(e.duration for e in queue[:position]))
+
+        for author in self.AUTHORS[:-1]:
+            mine = [e for e in queue if e.meta.get('author', None) == author]
+            self.assertEqual(index.count_for(author), len(mine))
+            self.assertEqual(index.duration_for(author), sum(e.duration for e in mine))
+
+    def append(self, index, queue, entry):
+        queue.append(entry)
+
+        if not index.append(entry):
+            index.rebuild(queue)
+
+    def test_against_a_list(self):
+        rng = random.Random(7)
+        index = QueueIndex()
+        queue = []
+
+        for step in range(3000):
+            op = rng.random()
+
+            if op < 0.5 or not queue:
+                self.append(index, queue, Entry(rng.randint(0, 600), rng.choice(self.AUTHORS)))
+
+            elif op < 0.7:
+                index.remove(queue.pop(0))
+
+            elif op < 0.85:
+                entry = queue.pop(rng.randrange(len(queue)))
+                index.remove(entry)
+
+            elif op < 0.95:
+                # Moving an entry reorders the queue, which rebuilds the index
+                entry = queue.pop(rng.randrange(len(queue)))
+                queue.insert(rng.randrange(len(queue) + 1), entry)
+                index.rebuild(queue)
+
+            else:
+                rng.shuffle(queue)
+                index.rebuild(queue)
+
+            if step % 25 == 0:
+                self.assertMatches(index, queue)
+
+        self.assertMatches(index, queue)
+
+    def test_grows_past_its_capacity(self):
+        index = QueueIndex()
+        queue = []
+
+        for i in range(QueueIndex.MIN_CAPACITY * 3):
+            self.append(index, queue, Entry(i, 'a'))
+
+        self.assertMatches(index, queue)
+
+    def test_remove_unknown_entry(self):
+        index = QueueIndex()
+        queue = [Entry(10, 'a'), Entry(20, 'b')]
+        index.rebuild(queue)
+
+        index.remove(Entry(30, 'a'))
+        self.assertMatches(index, queue)
+
+    def test_empty(self):
+        index = QueueIndex()
+
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.duration_until(5), 0)
+        self.assertEqual(index.count_for('a'), 0)
+        self.assertEqual(index.duration_for('a'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()